@@ -2,6 +2,7 @@ import argparse
 import inquirer
 import os
 from dotenv import load_dotenv
+from .server import serve
 
 # Load .env file
 load_dotenv()
@@ -46,6 +47,16 @@ def cli(interpreter):
                       action='store_true',
                       default=USE_AZURE,
                       help='use Azure OpenAI Services')
+  parser.add_argument('--serve',
+                      action='store_true',
+                      help='serve sessions over HTTP instead of chatting in the terminal')
+  parser.add_argument('--host',
+                      default='127.0.0.1',
+                      help='address to serve on (with --serve)')
+  parser.add_argument('--port',
+                      type=int,
+                      default=8000,
+                      help='port to serve on (with --serve)')
   args = parser.parse_args()
 
   # Modify interpreter according to command line flags
@@ -61,5 +72,10 @@ def cli(interpreter):
     interpreter.use_azure = True
     interpreter.local = False
 
+  if args.serve:
+    # Serve sessions of this interpreter (with the settings above) over HTTP
+    serve(interpreter, args.host, args.port)
+    return
+
   # Run the chat method
   interpreter.chat()
@@ -5,6 +5,9 @@ from rich.syntax import Syntax
 from rich.table import Table
 from rich.console import Group
 from rich.console import Console
+from functools import lru_cache
+from .render_scheduler import RenderScheduler
+from .utils import Fragments
 
 
 class CodeBlock:
@@ -12,35 +15,58 @@ class CodeBlock:
   Code Blocks display code and outputs in different languages.
   """
 
-  def __init__(self):
+  def __init__(self, fps=30):
     # Define these for IDE auto-completion
     self.language = ""
     self.output = ""
-    self.code = ""
+    self.code_pieces = Fragments()
     self.active_line = None
+    self.cursor = True
 
     self.live = Live(auto_refresh=False, console=Console(), vertical_overflow="visible")
     self.live.start()
 
-  def update_from_message(self, message):
-    if "function_call" in message and "parsed_arguments" in message[
-        "function_call"]:
+    # Refreshes happen on every token and output line, so we only draw `fps` frames per second
+    self.render_scheduler = RenderScheduler(self.render, fps)
 
-      parsed_arguments = message["function_call"]["parsed_arguments"]
+  @property
+  def code(self):
+    # Joined when a frame is drawn (or the code is run), not on every token
+    return self.code_pieces.text()
 
-      if parsed_arguments != None:
-        self.language = parsed_arguments.get("language")
-        self.code = parsed_arguments.get("code")
+  @code.setter
+  def code(self, code):
+    self.code_pieces = Fragments([code])
 
-        if self.code and self.language:
-          self.refresh()
+  def add_code(self, language, delta):
+    """
+    Appends the code that just streamed in.
+    """
+    self.language = language
+    self.code_pieces.append(delta)
+
+    if self.language and any(self.code_pieces):
+      self.refresh()
+
+  @property
+  def dropped_frames(self):
+    return self.render_scheduler.dropped_frames
 
   def end(self):
-    self.refresh(cursor=False)
+    # Draw the final frame
+    self.cursor = False
+    self.render_scheduler.close()
     # Destroys live display
     self.live.stop()
 
   def refresh(self, cursor=True):
+    self.cursor = cursor
+    if cursor:
+      self.render_scheduler.request()
+    else:
+      self.render_scheduler.flush()
+
+  def render(self):
     # Get code, return if there is none
     code = self.code
     if not code:
@@ -55,20 +81,19 @@ class CodeBlock:
     code_table.add_column()
 
     # Add cursor    
-    if cursor:
+    if self.cursor:
       code += "█"
 
     # Add each line of code to the table
+    # (Highlighted lines are cached, so usually only the last line is highlighted again)
     code_lines = code.strip().split('\n')
     for i, line in enumerate(code_lines, start=1):
       if i == self.active_line:
         # This is the active line, print it with a white background
-        syntax = Syntax(line, self.language, theme="bw", line_numbers=False, word_wrap=True)
-        code_table.add_row(syntax, style="black on white")
+        code_table.add_row(highlight_line(line, self.language, True), style="black on white")
       else:
         # This is not the active line, print it normally
-        syntax = Syntax(line, self.language, theme="monokai", line_numbers=False, word_wrap=True)
-        code_table.add_row(syntax)
+        code_table.add_row(highlight_line(line, self.language, False))
 
     # Create a panel for the code
     code_panel = Panel(code_table, box=MINIMAL, style="on #272722")
@@ -90,3 +115,33 @@ class CodeBlock:
     # Update the live display
     self.live.update(group)
     self.live.refresh()
+
+
+@lru_cache(maxsize=2048)
+def highlight_line(line, language, is_active_line):
+  """
+  Returns a syntax highlighted line of code, shared by every refresh (and every Code Block) that shows it.
+  """
+  theme = "bw" if is_active_line else "monokai"
+  return HighlightedLine(Syntax(line, language, theme=theme, line_numbers=False, word_wrap=True))
+
+
+class HighlightedLine:
+  """
+  Wraps a line's Syntax and remembers how it rendered at the last width,
+  so an unchanged line isn't highlighted again.
+  """
+
+  def __init__(self, syntax):
+    self.syntax = syntax
+    self.width = None
+    self.segments = None
+
+  def __rich_console__(self, console, options):
+    if self.width != options.max_width:
+      self.segments = list(console.render(self.syntax, options))
+      self.width = options.max_width
+    return self.segments
+
+  def __rich_measure__(self, console, options):
+    return self.syntax.__rich_measure__(console, options)
@@ -1,15 +1,29 @@
-import subprocess
+import asyncio
+import collections
+import codecs
 import webbrowser
 import tempfile
 import threading
 import traceback
 import platform
-import time
 import ast
 import astor
 import sys
 import os
 import re
+import select
+import json
+import math
+import shlex
+import signal
+import subprocess
+from .process_pool import spawn_process
+
+try:
+  import resource
+except ImportError:
+  # Windows has no rlimits
+  resource = None
 
 
 def run_html(html_content):
@@ -23,29 +37,72 @@ def run_html(html_content):
     return f"Saved to {os.path.realpath(f.name)} and opened with the user's default web browser."
 
 
+def child_pids(pid):
+  # Linux lists each thread's children in /proc. Elsewhere, we don't find any
+  children = []
+  try:
+    for task in os.listdir(f"/proc/{pid}/task"):
+      with open(f"/proc/{pid}/task/{task}/children") as f:
+        children += [int(child) for child in f.read().split()]
+  except OSError:
+    pass
+  return children
+
+
+line_break = re.compile(r"\r\n|\r|\n")
+
+# Limits on each run of a language's code ("limits" in language_map), where None is no limit:
+#   wall_time  seconds the run can take
+#   cpu_time   seconds of CPU time it can use
+#   memory     bytes of address space its process can have
+#   processes  processes the user can have (an rlimit counts all of the user's processes, not just ours)
+# All but wall_time are set as rlimits, so they're only enforced on Linux
+no_limits = {"wall_time": None, "cpu_time": None, "memory": None, "processes": None}
+
+# What a run prints when it runs into its memory or processes rlimit. Those don't stop the process,
+# they make what it tried fail, so we look for the failure in its output
+limit_errors = {
+  "memory": re.compile(r"MemoryError|Cannot allocate memory|[Oo]ut of memory|std::bad_alloc"),
+  "processes": re.compile(r"Resource temporarily unavailable"),
+}
+
+python_kernel_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "python_kernel.py")
+
 # Mapping of languages to their start, run, and print commands
 language_map = {
   "python": {
-    # Python is run from this interpreter with sys.executable
-    # in interactive, quiet, and unbuffered mode
-    "start_cmd": sys.executable + " -i -q -u",
-    "print_cmd": 'print("{}")'
+    # Python is run from this interpreter with sys.executable, running our kernel (see python_kernel.py)
+    # On Windows, where there's no control pipe, it runs in interactive, quiet, and unbuffered mode
+    "start_cmd": sys.executable + (" -i -q -u" if platform.system() == 'Windows' else " -u " + python_kernel_path),
+    "kernel": platform.system() != 'Windows',
+    "print_cmd": 'print("{}")',
+    "chdir_cmd": lambda path: f"import os; os.chdir({path!r})",
+    "limits": dict(no_limits)
   },
   "shell": {
     # On Windows, the shell start command is `cmd.exe`
     # On Unix, it should be the SHELL environment variable (defaults to 'bash' if not set)
     "start_cmd": 'cmd.exe' if platform.system() == 'Windows' else os.environ.get('SHELL', 'bash'),
-    "print_cmd": 'echo "{}"'
+    "print_cmd": 'echo "{}"',
+    "chdir_cmd": lambda path: f'cd /d "{path}"' if platform.system() == 'Windows' else f"cd {shlex.quote(path)}",
+    "limits": dict(no_limits)
   },
   "javascript": {
     "start_cmd": "node -i",
-    "print_cmd": 'console.log("{}")'
+    "print_cmd": 'console.log("{}")',
+    "chdir_cmd": lambda path: f"process.chdir({json.dumps(path)})",
+    # Defines a function that sends a line to us over the control pipe (see spawn_process)
+    "control_setup": 'var _oi_ctl = (message) => {{ require("fs").writeSync({fd}, message + "\\n") }}',
+    "control_function": "_oi_ctl",
+    "limits": dict(no_limits)
   },
   "applescript": {
     # Starts from shell, whatever the user's preference (defaults to '/bin/zsh')
     # (We'll prepend "osascript -e" every time, not once at the start, so we want an empty shell)
     "start_cmd": os.environ.get('SHELL', '/bin/zsh'),
-    "print_cmd": 'log "{}"'
+    "print_cmd": 'log "{}"',
+    "chdir_cmd": lambda path: f"cd {shlex.quote(path)}",
+    "limits": dict(no_limits)
   },
   "html": {
     "open_subrocess": False,
@@ -67,50 +124,374 @@ class CodeInterpreter:
   They can control code blocks on the terminal, then be executed to produce an output which will be displayed in real-time.
   """
 
-  def __init__(self, language, debug_mode):
+  def __init__(self, language, debug_mode, emit=None, languages=None, working_directory=None, process_pool=None):
     self.language = language
     self.proc = None
     self.active_line = None
     self.debug_mode = debug_mode
 
-  def start_process(self):
+    # Called with `output_line` and `active_line` events, if set (see Interpreter.headless)
+    self.emit = emit
+
+    # Sessions (see Interpreter.create_session) bring their own copy of language_map,
+    # and a directory to start processes in (None is our own working directory)
+    self.languages = languages if languages is not None else language_map
+    self.working_directory = working_directory
+
+    # Where to get a started process from, if anywhere (see ProcessPool)
+    self.process_pool = process_pool
+
+    self.output_buffer = OutputBuffer()
+
+    # Set by start_process (see there)
+    self.control_fd = None
+    self.kernel = False
+    self.open_fds = set()
+
+    # Set once the code we're running has finished (so it's set when nothing's running)
+    self.done = threading.Event()
+    self.done.set()
+
+    # Like {"limit": "wall_time", "value": 30} if the last run was stopped by a limit (see no_limits)
+    self.limit_exceeded = None
+    self.limit_hit = None
+
+  def start_process(self, watch_streams=True):
     # Get the start_cmd for the selected language
-    start_cmd = language_map[self.language]["start_cmd"]
+    start_cmd = self.languages[self.language]["start_cmd"]
 
     # Use the appropriate start_cmd to execute the code
-    self.proc = subprocess.Popen(start_cmd.split(),
-                                 stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 text=True,
-                                 bufsize=0)
-
-    # Start watching ^ its `stdout` and `stderr` streams
-    threading.Thread(target=self.save_and_display_stream,
-                     args=(self.proc.stdout, False), # Passes False to is_error_stream
-                     daemon=True).start()
-    threading.Thread(target=self.save_and_display_stream,
-                     args=(self.proc.stderr, True), # Passes True to is_error_stream
-                     daemon=True).start()
+    if self.process_pool:
+      self.proc = self.process_pool.acquire(start_cmd)
+    else:
+      self.proc = spawn_process(start_cmd, self.working_directory)
+
+    # Python and JavaScript tell us the active line (and when they're done) over the control pipe,
+    # where it can't mix with their output. Elsewhere (or without a pipe, on Windows) it's printed.
+    # Python's kernel sends its output over the control pipe too
+    language = self.languages[self.language]
+    self.control_fd = None
+    self.kernel = False
+    self.frames = b""
+    if self.proc.control_fd is not None:
+      if language.get("kernel"):
+        self.control_fd = self.proc.control_fd
+        self.kernel = True
+      elif "control_setup" in language:
+        self.control_fd = self.proc.control_fd
+        self.write_code(language["control_setup"].format(fd=self.proc.child_control_fd))
+
+    # Pooled processes were started elsewhere, so they're moved to our working directory
+    chdir_cmd = language.get("chdir_cmd")
+    if self.process_pool and self.working_directory and chdir_cmd:
+      self.write_code(chdir_cmd(self.working_directory), reply=False)
+
+    # Which pipe is which, and output that's been read but hasn't ended in a newline yet (see read_output)
+    self.channels = {self.proc.stdout.fileno(): "stdout", self.proc.stderr.fileno(): "stderr"}
+    if self.control_fd is not None:
+      self.channels[self.control_fd] = "control"
+    # (kept as pieces, so a long line isn't copied every time more of it arrives)
+    self.partial_lines = {channel: [] for channel in self.channels.values()}
+    self.partial_lengths = {channel: 0 for channel in self.channels.values()}
+    # The pipes that haven't been closed (see close_channel)
+    self.open_fds = set(self.channels)
+    self.decoders = {channel: codecs.getincrementaldecoder("utf-8")(errors="replace")
+                     for channel in self.channels.values()}
+
+    # Pipes are read when select() (or the event loop) says they're readable.
+    # They don't block, since drain_output might have read them first
+    if platform.system() != "Windows":
+      for fd in self.channels:
+        os.set_blocking(fd, False)
+
+    # arun() reads the pipes from the event loop instead
+    self.watching_with_threads = watch_streams
+    if not watch_streams:
+      return
+
+    if platform.system() == "Windows":
+      # Windows can't select() on pipes, so each stream gets a thread
+      threading.Thread(target=self.save_and_display_stream,
+                       args=(self.proc, self.proc.stdout, False), # Passes False to is_error_stream
+                       daemon=True).start()
+      threading.Thread(target=self.save_and_display_stream,
+                       args=(self.proc, self.proc.stderr, True), # Passes True to is_error_stream
+                       daemon=True).start()
+    else:
+      # Start watching ^ its `stdout`, `stderr` and control pipes
+      threading.Thread(target=self.watch_pipes, args=(self.proc,), daemon=True).start()
+
+  def write_code(self, code, reply=True):
+    """
+    Writes code to the process's stdin. The kernel takes it as a message, and only tells us
+    when it's done if `reply` is True. (REPLs only do that when we add an END_OF_EXECUTION print.)
+    """
+    if self.kernel:
+      message = json.dumps({"code": code, "reply": reply}).encode()
+      self.proc.stdin.write(len(message).to_bytes(4, "big") + message)
+    else:
+      self.proc.stdin.write((code + "\n").encode())
+    self.proc.stdin.flush()
+
+  @property
+  def limits(self):
+    return self.languages[self.language].get("limits", no_limits)
+
+  def apply_limits(self):
+    """
+    Sets the process's rlimits for the next run (see no_limits), on Linux.
+    Its cpu_time limit counts from the CPU time it's used so far.
+    """
+    self.limit_hit = None
+    if not hasattr(resource, "prlimit") or self.proc is None:
+      return
+
+    cpu_time = self.limits.get("cpu_time")
+    if cpu_time is not None:
+      cpu_time = math.ceil(self.cpu_time_used() + cpu_time)
+
+    try:
+      for rlimit, value in [(resource.RLIMIT_CPU, cpu_time),
+                            (resource.RLIMIT_AS, self.limits.get("memory")),
+                            (resource.RLIMIT_NPROC, self.limits.get("processes"))]:
+        # Only the soft limit is set, since we couldn't raise the hard limit again
+        soft, hard = resource.prlimit(self.proc.pid, rlimit)
+        if value is None:
+          value = hard
+        elif hard != resource.RLIM_INFINITY:
+          value = min(value, hard)
+        if value != soft:
+          resource.prlimit(self.proc.pid, rlimit, (value, hard))
+    except ProcessLookupError:
+      # It's exited. Writing the code to it will fail, and start a new one
+      pass
+
+  def cpu_time_used(self):
+    """
+    Returns the seconds of CPU time the process has used (not counting its children).
+    """
+    try:
+      with open(f"/proc/{self.proc.pid}/stat") as f:
+        # The fields after the command (which might contain spaces) are state, ppid, ... utime, stime
+        fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+      return 0
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+  @property
+  def output(self):
+    # Output is kept (and truncated) by an OutputBuffer
+    return str(self.output_buffer)
+
+  @output.setter
+  def output(self, output):
+    self.output_buffer = OutputBuffer()
+    for line in output.split("\n"):
+      self.output_buffer.append(line)
 
   def update_active_block(self):
-      """
-      This will also truncate the output,
-      which we need to do every time we update the active block.
-      """
-      # Strip then truncate the output if necessary
-      self.output = truncate_output(self.output)
-  
       # Display it
       self.active_block.active_line = self.active_line
       self.active_block.output = self.output
       self.active_block.refresh()
 
+  def report_error(self):
+    """
+    Makes the traceback of the exception we're handling our output.
+    """
+    traceback_string = traceback.format_exc()
+    self.output = traceback_string
+    self.emit_output(traceback_string, True)
+    self.update_active_block()
+
   def run(self):
     """
     Executes code.
     """
 
+    # Should we keep a subprocess open? True by default
+    open_subrocess = self.languages[self.language].get("open_subrocess", True)
+
+    # Start the subprocess if it hasn't been started
+    if not self.proc and open_subrocess:
+      try:
+        self.start_process()
+      except:
+        # Sometimes start_process will fail!
+        # Like if they don't have `node` installed or something.
+        self.report_error()
+        return self.output
+
+    # A process that arun() started isn't being watched by threads yet
+    if self.proc and not self.watching_with_threads:
+      self.proc.kill()
+      self.proc = None
+      return self.run()
+
+    code = self.prepare_code()
+    if code is None:
+      return self.output
+
+    # Reset self.done so we can .wait() for it
+    # (it's set once the code has finished and all its output has been read)
+    self.done = threading.Event()
+    self.apply_limits()
+
+    # Write code to stdin of the process
+    try:
+      self.write_code(code)
+    except BrokenPipeError:
+      # It can just.. break sometimes? Let's fix this better in the future
+      # For now, just try again
+      self.start_process()
+      return self.run()
+
+    # Wait until execution completes, or its wall_time limit is up
+    timed_out = not self.done.wait(self.limits.get("wall_time"))
+    if timed_out:
+      self.kill_process()
+      # Once its pipes close, what's left in them has been read
+      self.done.wait(1)
+    self.finish_run(timed_out)
+
+    # Return code output
+    return self.output
+
+  async def arun(self):
+    """
+    Executes code, like run(), but waits for it on the running asyncio event loop
+    instead of in a thread, so many Code Interpreters can run at once.
+    """
+    loop = asyncio.get_running_loop()
+
+    # The Windows event loop can't watch pipes, so there we run in the default executor
+    if platform.system() == "Windows":
+      return await loop.run_in_executor(None, self.run)
+
+    # Should we keep a subprocess open? True by default
+    open_subrocess = self.languages[self.language].get("open_subrocess", True)
+
+    # A process that run() started is already being read by threads, so we start a fresh one
+    if self.proc and self.watching_with_threads:
+      self.proc.kill()
+      self.proc = None
+
+    # Start the subprocess if it hasn't been started
+    if not self.proc and open_subrocess:
+      try:
+        self.start_process(watch_streams=False)
+      except:
+        self.report_error()
+        return self.output
+
+    code = self.prepare_code()
+    if code is None:
+      return self.output
+
+    self.done = asyncio.Event()
+    self.apply_limits()
+
+    for fd in self.channels:
+      loop.add_reader(fd, self.read_ready, fd)
+
+    timed_out = False
+    try:
+      # Write code to stdin of the process
+      try:
+        self.write_code(code)
+      except BrokenPipeError:
+        # Start over with a new process
+        self.proc = None
+      else:
+        # Wait until execution completes, or its wall_time limit is up
+        try:
+          await asyncio.wait_for(self.done.wait(), self.limits.get("wall_time"))
+        except asyncio.TimeoutError:
+          timed_out = True
+          self.kill_process()
+          # Once its pipes close, what's left in them has been read
+          try:
+            await asyncio.wait_for(self.done.wait(), 1)
+          except asyncio.TimeoutError:
+            pass
+    finally:
+      for fd in self.channels:
+        loop.remove_reader(fd)
+
+    if self.proc is None:
+      return await self.arun()
+
+    self.finish_run(timed_out)
+
+    # Return code output
+    return self.output
+
+  def kill_process(self):
+    """
+    Kills the process, and on Linux, the processes it started (which would otherwise keep running, with its pipes open).
+    """
+    pids = [self.proc.pid]
+    for pid in pids:
+      pids += child_pids(pid)
+
+    self.proc.kill()
+    for pid in pids[1:]:
+      try:
+        os.kill(pid, signal.SIGKILL)
+      except OSError:
+        # It's exited already
+        pass
+
+  def finish_run(self, timed_out):
+    """
+    Lets go of the process if it's exited (the next run starts a new one),
+    and reports the limit that stopped the run (or that it ran into), if one did.
+    """
+    limit = "wall_time" if timed_out else self.limit_hit
+
+    if self.proc and (timed_out or not self.open_fds):
+      try:
+        returncode = self.proc.wait(1)
+      except subprocess.TimeoutExpired:
+        # It closed its pipes, but didn't exit
+        self.proc.kill()
+        returncode = self.proc.wait()
+      self.proc = None
+
+      # Going over an RLIMIT_CPU soft limit sends SIGXCPU, which ends the process
+      if not timed_out and hasattr(signal, "SIGXCPU") and returncode == -signal.SIGXCPU:
+        limit = "cpu_time"
+
+    self.limit_exceeded = None
+    if limit:
+      self.report_limit(limit)
+
+  def report_limit(self, limit):
+    """
+    Tells the LLM (and whoever's listening for events) that the run was stopped by `limit`,
+    or, for memory and processes, that what it tried failed because of it.
+    """
+    value = self.limits.get(limit)
+    self.limit_exceeded = {"limit": limit, "value": value}
+
+    if limit in ["wall_time", "cpu_time"]:
+      message = (f"LimitExceeded: this code went over its {limit} limit ({value}), so it was stopped. "
+                 "Variables from earlier code are gone.")
+    else:
+      message = f"LimitExceeded: this code ran into its {limit} limit ({value}), so it failed."
+    self.output_buffer.append(message)
+    self.emit_output(message, True)
+    if self.emit:
+      self.emit({"type": "limit_exceeded", "language": self.language, **self.limit_exceeded})
+    self.update_active_block()
+
+  def prepare_code(self):
+    """
+    Gets the active block's code ready to be written to the process.
+
+    Returns None if there's nothing to write, in which case self.output says why.
+    """
+
     # Get code to execute
     self.code = self.active_block.code
 
@@ -124,32 +505,16 @@ class CodeInterpreter:
         return message
     """
 
-    # Should we keep a subprocess open? True by default
-    open_subrocess = language_map[self.language].get("open_subrocess", True)
-
-    # Start the subprocess if it hasn't been started
-    if not self.proc and open_subrocess:
-      try:
-        self.start_process()
-      except:
-        # Sometimes start_process will fail!
-        # Like if they don't have `node` installed or something.
-        
-        traceback_string = traceback.format_exc()
-        self.output = traceback_string
-        self.update_active_block()
-  
-        # Before you return, wait for the display to catch up?
-        # (I'm not sure why this works)
-        time.sleep(0.1)
-  
-        return self.output
-
     # Reset output
     self.output = ""
 
-    # Use the print_cmd for the selected language
-    self.print_cmd = language_map[self.language].get("print_cmd")
+    # Use the print_cmd for the selected language, or send control messages over the control pipe.
+    # The kernel samples the line that's running itself, so its code runs as written
+    self.print_cmd = self.languages[self.language].get("print_cmd")
+    if self.kernel:
+      self.print_cmd = None
+    elif self.control_fd is not None:
+      self.print_cmd = self.languages[self.language]["control_function"] + '("{}")'
     code = self.code
 
     # Add print commands that tell us what the active line is
@@ -159,31 +524,26 @@ class CodeInterpreter:
       except:
         # If this failed, it means the code didn't compile
         # This traceback will be our output.
-        
-        traceback_string = traceback.format_exc()
-        self.output = traceback_string
-        self.update_active_block()
-  
-        # Before you return, wait for the display to catch up?
-        # (I'm not sure why this works)
-        time.sleep(0.1)
-  
-        return self.output
+        self.report_error()
+        return None
 
-    if self.language == "python":
-      # This lets us stop execution when error happens (which is not default -i behavior)
-      # And solves a bunch of indentation problems-- if everything's indented, -i treats it as one block
-      code = wrap_in_try_except(code)
+    # The kernel runs code as a whole, and tells us when it's done.
+    # The rest is for feeding it into a REPL
+    if not self.kernel:
+      if self.language == "python":
+        # This lets us stop execution when error happens (which is not default -i behavior)
+        # And solves a bunch of indentation problems-- if everything's indented, -i treats it as one block
+        code = wrap_in_try_except(code)
 
-    # Remove any whitespace lines, as this will break indented blocks
-    # (are we sure about this? test this)
-    code_lines = code.split("\n")
-    code_lines = [c for c in code_lines if c.strip() != ""]
-    code = "\n".join(code_lines)
+      # Remove any whitespace lines, as this will break indented blocks
+      # (are we sure about this? test this)
+      code_lines = code.split("\n")
+      code_lines = [c for c in code_lines if c.strip() != ""]
+      code = "\n".join(code_lines)
 
-    # Add end command (we'll be listening for this so we know when it ends)
-    if self.print_cmd and self.language != "applescript": # Applescript is special. Needs it to be a shell command because 'return' (very common) will actually return, halt script
-      code += "\n\n" + self.print_cmd.format('END_OF_EXECUTION')
+      # Add end command (we'll be listening for this so we know when it ends)
+      if self.print_cmd and self.language != "applescript": # Applescript is special. Needs it to be a shell command because 'return' (very common) will actually return, halt script
+        code += "\n\n" + self.print_cmd.format('END_OF_EXECUTION')
 
     # Applescript-specific processing
     if self.language == "applescript":
@@ -204,33 +564,10 @@ class CodeInterpreter:
 
     # HTML-specific processing (and running)
     if self.language == "html":
-      output = language_map["html"]["run_function"](code)
-      return output
+      self.output = self.languages["html"]["run_function"](code)
+      return None
 
-    # Reset self.done so we can .wait() for it
-    self.done = threading.Event()
-    self.done.clear()
-
-    # Write code to stdin of the process
-    try:
-      self.proc.stdin.write(code + "\n")
-      self.proc.stdin.flush()
-    except BrokenPipeError:
-      # It can just.. break sometimes? Let's fix this better in the future
-      # For now, just try again
-      self.start_process()
-      self.run()
-      return
-
-    # Wait until execution completes
-    self.done.wait()
-
-    # Before you return, wait for the display to catch up?
-    # (I'm not sure why this works)
-    time.sleep(0.1)
-
-    # Return code output
-    return self.output
+    return code
 
   def add_active_line_prints(self, code):
     """
@@ -288,66 +625,308 @@ class CodeInterpreter:
     code = "\n".join(modified_code_lines)
     return code
 
-  def save_and_display_stream(self, stream, is_error_stream):
-    # Handle each line of output
-    for line in iter(stream.readline, ''):
+  def save_and_display_stream(self, proc, stream, is_error_stream):
+    # Handle each chunk of output, as soon as there's some
+    channel = "stderr" if is_error_stream else "stdout"
+    for data in iter(lambda: stream.read1(65536), b''):
+      self.handle_output_text(self.decoders[channel].decode(data), channel)
+    self.close_channel(stream.fileno(), proc)
 
-      if self.debug_mode:
-        print("Recieved output line:")
-        print(line)
-        print("---")
-      
-      line = line.strip()
-
-      # Node's interactive REPL outputs a billion things
-      # So we clean it up:
-      if self.language == "javascript":
-        if "Welcome to Node.js" in line:
-          continue
-        if line in ["undefined", 'Type ".help" for more information.']:
-          continue
-        # Remove trailing ">"s
-        line = re.sub(r'^\s*(>\s*)+', '', line)
-
-      # Python's interactive REPL outputs a million things
-      # So we clean it up:
-      if self.language == "python":
-        if re.match(r'^(\s*>>>\s*|\s*\.\.\.\s*)', line):
-          continue
-
-      # Check if it's a message we added (like ACTIVE_LINE)
-      # Or if we should save it to self.output
-      if line.startswith("ACTIVE_LINE:"):
-        self.active_line = int(line.split(":")[1])
-      elif "END_OF_EXECUTION" in line:
-        self.done.set()
-        self.active_line = None
-      elif is_error_stream and "KeyboardInterrupt" in line:
-        raise KeyboardInterrupt
+  def watch_pipes(self, proc):
+    """
+    Reads the process's output and control messages as they arrive. Runs in a thread.
+    """
+    fds = list(self.channels)
+    while fds and proc is self.proc:
+      readable, _, _ = select.select(fds, [], [])
+      for fd in readable:
+        try:
+          if not self.read_output(fd):
+            fds.remove(fd)
+            self.close_channel(fd, proc)
+        except KeyboardInterrupt:
+          self.done.set()
+
+  def read_ready(self, fd):
+    """
+    arun() has the event loop call this whenever one of the process's pipes is readable.
+    """
+    try:
+      if not self.read_output(fd):
+        # The process closed this pipe
+        asyncio.get_running_loop().remove_reader(fd)
+        self.close_channel(fd, self.proc)
+    except KeyboardInterrupt:
+      # Don't take the whole event loop down with us
+      self.done.set()
+
+  def read_output(self, fd):
+    """
+    Reads what's available on one of the process's pipes, and handles each complete line
+    (or message, from the kernel).
+
+    Returns False once the pipe is closed.
+    """
+    try:
+      data = os.read(fd, 65536)
+    except BlockingIOError:
+      # drain_output got to it first
+      return True
+    if not data:
+      return False
+
+    channel = self.channels[fd]
+    if channel == "control" and self.kernel:
+      self.read_frames(data)
+    else:
+      self.handle_output_text(self.decoders[channel].decode(data), channel)
+
+    return True
+
+  def handle_output_text(self, text, channel):
+    pieces = self.partial_lines[channel]
+
+    # A "\r" held back last time might be the start of a "\r\n"
+    if pieces and pieces[-1].endswith("\r"):
+      pieces[-1] = pieces[-1][:-1]
+      self.partial_lengths[channel] -= 1
+      text = "\r" + text
+
+    # A "\r" at the end might be the start of a "\r\n"
+    held_back = ""
+    if text.endswith("\r"):
+      text, held_back = text[:-1], "\r"
+
+    # Progress bars redraw their line after a "\r", so that ends a line too
+    # (Only the new text is split. The partial line's pieces are joined once, when it ends)
+    lines = line_break.split(text)
+    last = lines.pop() + held_back
+    if lines:
+      lines[0] = "".join(pieces) + lines[0]
+      pieces = self.partial_lines[channel] = []
+      self.partial_lengths[channel] = 0
+    pieces.append(last)
+    self.partial_lengths[channel] += len(last)
+
+    # A line that never ends is handled in parts, so what's held stays bounded like the output buffer
+    if channel != "control" and self.partial_lengths[channel] > self.output_buffer.head_chars + self.output_buffer.tail_chars:
+      lines.append("".join(pieces).rstrip("\r"))
+      self.partial_lines[channel] = []
+      self.partial_lengths[channel] = 0
+
+    for line in lines:
+      if channel == "control":
+        self.handle_control_line(line)
       else:
-        self.output += "\n" + line
-        self.output = self.output.strip()
+        self.handle_output_line(line, channel == "stderr")
 
+    # Once per chunk of output, rather than per line
+    if lines and channel != "control":
       self.update_active_block()
 
-def truncate_output(data):
-  needs_truncation = False
-
-  # In the future, this will come from a config file
-  max_output_chars = 2000
+  def read_frames(self, data):
+    """
+    Handles each complete message from the kernel (see python_kernel.py) in `data`,
+    keeping any partial message for next time.
+    """
+    frames = self.frames + data
+    start = 0
+    while len(frames) - start >= 4:
+      length = int.from_bytes(frames[start:start + 4], "big")
+      if len(frames) - start < 4 + length:
+        break
+      message = json.loads(frames[start + 4:start + 4 + length])
+      start += 4 + length
+      self.handle_kernel_message(message)
+    self.frames = frames[start:]
+
+  def handle_kernel_message(self, message):
+    if message["type"] in ["stdout", "stderr"]:
+      self.handle_output_text(message["text"], message["type"])
+    elif message["type"] == "active_line":
+      self.set_active_line(message["line"])
+      self.update_active_block()
+    elif message["type"] == "done":
+      # Output the code's subprocesses wrote might still be waiting in the pipes
+      self.drain_output()
+      self.flush_partial_lines()
+      self.set_active_line(None)
+      self.update_active_block()
+      self.done.set()
 
-  message = f'Output truncated. Showing the last {max_output_chars} characters.\n\n'
+  def handle_control_line(self, line):
+    if line.startswith("ACTIVE_LINE:"):
+      self.set_active_line(int(line.split(":")[1]))
+      self.update_active_block()
+    elif line == "END_OF_EXECUTION":
+      # Output written before this is already in its pipe, but might not have been read yet
+      self.drain_output()
+      self.set_active_line(None)
+      self.update_active_block()
+      self.done.set()
 
-  # Remove previous truncation message if it exists
-  if data.startswith(message):
-    data = data[len(message):]
-    needs_truncation = True
+  def close_channel(self, fd, proc):
+    """
+    Called when one of `proc`'s pipes is closed. Once they all are, it's exited (maybe stopped by a limit),
+    so the code it was running won't be telling us it's done.
+    """
+    if proc is not self.proc:
+      return
 
-  # If data exceeds max length, truncate it and add message
-  if len(data) > max_output_chars or needs_truncation:
-    data = message + data[-max_output_chars:]
+    self.open_fds.discard(fd)
+    if not self.open_fds and not self.done.is_set():
+      self.flush_partial_lines()
+      self.set_active_line(None)
+      self.update_active_block()
+      self.done.set()
+
+  def flush_partial_lines(self):
+    # Output that didn't end in a newline won't be getting one
+    for channel in ["stdout", "stderr"]:
+      line = "".join(self.partial_lines[channel])
+      self.partial_lines[channel] = []
+      self.partial_lengths[channel] = 0
+      if line:
+        self.handle_output_line(line, channel == "stderr")
+
+  def drain_output(self, channels=("stdout", "stderr")):
+    """
+    Reads all the output that's waiting in the process's stdout and stderr pipes (or just `channels`).
+    """
+    fds = [fd for fd, channel in self.channels.items() if channel in channels]
+    while fds:
+      readable, _, _ = select.select(fds, [], [], 0)
+      if not readable:
+        break
+      for fd in readable:
+        if not self.read_output(fd):
+          fds.remove(fd)
+
+  def handle_output_line(self, line, is_error_stream):
+    if self.debug_mode:
+      print("Recieved output line:")
+      print(line)
+      print("---")
+    
+    line = line.strip()
+
+    # Node's interactive REPL outputs a billion things
+    # So we clean it up:
+    if self.language == "javascript":
+      # Remove trailing ">"s
+      line = re.sub(r'^\s*(>\s*)+', '', line)
+      if "Welcome to Node.js" in line:
+        return
+      if line in ["undefined", 'Type ".help" for more information.']:
+        return
+
+    # Python's interactive REPL outputs a million things
+    # So we clean it up:
+    if self.language == "python" and not self.kernel:
+      if re.match(r'^(\s*>>>\s*|\s*\.\.\.\s*)', line):
+        return
+
+    # Check if it's a message we added (like ACTIVE_LINE), unless those come over the control pipe
+    # Or if we should save it to self.output
+    if self.control_fd is None and line.startswith("ACTIVE_LINE:"):
+      self.set_active_line(int(line.split(":")[1]))
+    elif self.control_fd is None and "END_OF_EXECUTION" in line:
+      # Errors written before this might still be waiting in stderr
+      if not is_error_stream and platform.system() != "Windows":
+        self.drain_output(["stderr"])
+      self.set_active_line(None)
+      self.update_active_block()
+      self.done.set()
+    elif is_error_stream and "KeyboardInterrupt" in line:
+      raise KeyboardInterrupt
+    else:
+      self.output_buffer.append(line)
+      self.emit_output(line, is_error_stream)
+      self.check_limit_hit(line)
+
+  def check_limit_hit(self, line):
+    """
+    Notes if `line` is a set memory or processes limit making something fail (see limit_errors).
+    """
+    if self.limit_hit is not None:
+      return
+    for limit, pattern in limit_errors.items():
+      if self.limits.get(limit) is not None and pattern.search(line):
+        self.limit_hit = limit
+        return
+
+  def set_active_line(self, active_line):
+    if active_line != self.active_line and self.emit:
+      self.emit({"type": "active_line", "line": active_line})
+    self.active_line = active_line
+
+  def emit_output(self, output, is_error_stream):
+    if self.emit:
+      for line in output.strip().split("\n"):
+        self.emit({"type": "output_line", "line": line, "is_error": is_error_stream})
+
+class OutputBuffer:
+  """
+  Holds a run's output a line at a time, keeping the first `head_chars` and the last `tail_chars`
+  characters of it. Lines in between are dropped as they're pushed out of the tail (and counted),
+  so however much a program prints, memory and the cost of each line stay bounded.
+  """
 
-  return data
+  def __init__(self, head_chars=1000, tail_chars=1000):
+    self.head_chars = head_chars
+    self.tail_chars = tail_chars
+
+    self.head = []
+    self.head_length = 0
+    self.tail = collections.deque()
+    self.tail_length = 0
+
+    self.dropped_lines = 0
+    self.dropped_bytes = 0
+
+    self.text = ""
+
+  def append(self, line):
+    # Lines go in the head until it's full, then the tail
+    if not self.tail and self.head_length + len(line) + 1 <= self.head_chars:
+      self.head.append(line)
+      self.head_length += len(line) + 1
+    else:
+      if not self.tail and self.head_length + 1 < self.head_chars and len(line) + 1 > self.head_chars:
+        # A line too long for the head on its own starts it off, and the rest goes in the tail
+        start = line[:self.head_chars - self.head_length - 1]
+        self.head.append(start)
+        self.head_length = self.head_chars
+        line = line[len(start):]
+
+      if len(line) > self.tail_chars:
+        # Keep the end of a line that's too long for the tail on its own
+        self.dropped_bytes += len(line[:-self.tail_chars].encode())
+        line = line[-self.tail_chars:]
+      self.tail.append(line)
+      self.tail_length += len(line) + 1
+
+      while self.tail_length > self.tail_chars + 1:
+        dropped_line = self.tail.popleft()
+        self.tail_length -= len(dropped_line) + 1
+        self.dropped_lines += 1
+        self.dropped_bytes += len(dropped_line.encode()) + 1
+
+    self.text = None
+
+  def __str__(self):
+    # Rendered when it's needed, then kept until the next line
+    if self.text is None:
+      text = "\n".join(self.head)
+      if self.dropped_lines:
+        text += f"\n\nOutput truncated. {self.dropped_lines} lines ({self.dropped_bytes} bytes) were left out here.\n\n"
+      elif self.dropped_bytes:
+        text += f"\n\nOutput truncated. {self.dropped_bytes} bytes were left out here.\n\n"
+      else:
+        text += "\n"
+      text += "\n".join(self.tail)
+      self.text = text.strip()
+    return self.text
 
 # Perhaps we should split the "add active line prints" processing to a new file?
 # Add active prints to python:
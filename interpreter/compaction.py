@@ -0,0 +1,129 @@
+import re
+
+code_block = re.compile(r"```(\w*)\n(.*?)(```|$)", re.DOTALL)
+error_line = re.compile(r"Error|Exception|Traceback|error:|failed", re.IGNORECASE)
+
+
+def summarize_message(message, max_line_length=200):
+  """
+  Summarizes a function output or assistant message by picking out its most telling lines.
+  Returns None if it's already about as short as a summary would be.
+  """
+  content = message.get("content")
+  if not isinstance(content, str):
+    return None
+
+  if message.get("role") == "function":
+    lines = content.split("\n")
+    if len(lines) <= 6 and len(content) <= 3 * max_line_length:
+      return None
+
+    # Its start, its end, and any errors in between
+    errors = [line for line in lines[2:-2] if error_line.search(line)][:3]
+    picked = lines[:2] + (["..."] + errors if errors else []) + ["..."] + lines[-2:]
+    summary = f"[Output summarized, from {len(lines)} lines]\n"
+    summary += "\n".join(line[:max_line_length] for line in picked)
+
+  elif message.get("role") == "assistant":
+    # Its first sentence, and what code it ran (the code's output is in the next message)
+    prose = code_block.sub("", content).strip()
+    summary = re.split(r"(?<=[.!?:])\s", prose, 1)[0][:max_line_length]
+    for language, code, _ in code_block.findall(content):
+      code_lines = code.strip().split("\n")
+      summary += f"\n[Ran {len(code_lines)} lines of {language or 'code'}, starting: {code_lines[0][:max_line_length]}]"
+
+  else:
+    return None
+
+  if len(summary) >= len(content):
+    return None
+  return summary
+
+
+class Compactor:
+  """
+  Once a conversation takes up more than `threshold` of its token budget, replaces its oldest
+  function outputs and assistant messages with summaries until it takes up `target` of it,
+  then if that's not enough, drops the oldest summaries.
+
+  The first user message (the task) and the last `keep_recent` messages are never summarized.
+  Summaries are reused (and dropped messages stay dropped) for as long as the messages are in
+  the conversation, so what's sent to the LLM only changes when more needs compacting.
+
+  `summarize` takes a message and returns a summary of its content, or None to leave it be.
+  By default it's extractive (see summarize_message), but it could ask a cheap model.
+  """
+
+  def __init__(self, token_ledger, summarize=summarize_message, threshold=0.75, target=0.5, keep_recent=2):
+    self.token_ledger = token_ledger
+    self.summarize = summarize
+    self.threshold = threshold
+    self.target = target
+    self.keep_recent = keep_recent
+    # id(message) -> (its content when summarized, the message with its summary)
+    self.summaries = {}
+    # ids of the messages we've dropped
+    self.dropped = set()
+
+  def compact(self, messages, max_tokens, system_message=None):
+    """
+    Returns `messages` as they should be sent: with the summaries we've made (and any we need to make now)
+    in place of the originals, and without the messages we've dropped. Messages are never changed.
+    """
+    count = self.token_ledger.count
+
+    # Forget messages that are gone (their ids could be reused)
+    ids = {id(message) for message in messages}
+    self.summaries = {message_id: summary for message_id, summary in self.summaries.items() if message_id in ids}
+    self.dropped &= ids
+
+    # What each message is sent as: itself, its summary, or None if it's dropped
+    shown = [self.shown(message) for message in messages]
+
+    total = sum(count(message) for message in shown if message is not None)
+    if system_message:
+      total += count(self.token_ledger.system_message_for(system_message))
+
+    if total > max_tokens * self.threshold:
+      task = first_user_message(messages)
+      old = [i for i in range(len(messages) - self.keep_recent) if messages[i] is not task]
+
+      for i in old:
+        if total <= max_tokens * self.target:
+          break
+        if shown[i] is not messages[i]:
+          continue
+
+        summary = self.summarize(messages[i])
+        if summary is None:
+          continue
+
+        summarized = {key: messages[i][key] for key in ["role", "name"] if key in messages[i]}
+        summarized["content"] = summary
+        total += count(summarized) - count(messages[i])
+        self.summaries[id(messages[i])] = (messages[i]["content"], summarized)
+        shown[i] = summarized
+
+      for i in old:
+        if total <= max_tokens * self.target:
+          break
+        if shown[i] is None or shown[i] is messages[i]:
+          continue
+
+        total -= count(shown[i])
+        self.dropped.add(id(messages[i]))
+        shown[i] = None
+
+    return [message for message in shown if message is not None]
+
+  def shown(self, message):
+    if id(message) in self.dropped:
+      return None
+    summary = self.summaries.get(id(message))
+    if summary is not None and summary[0] == message.get("content"):
+      return summary[1]
+    return message
+
+
+def first_user_message(messages):
+  return next((message for message in messages if message.get("role") == "user"), None)
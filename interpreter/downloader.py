@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from urllib.parse import urljoin
+
+
+class DownloadError(Exception):
+  pass
+
+
+class NoRedirects(urllib.request.HTTPRedirectHandler):
+  # So resolve() sees each redirect's headers (and follows them itself)
+  def redirect_request(self, req, fp, code, msg, headers, newurl):
+    return None
+
+
+def resolve(url, max_redirects=10, timeout=60):
+  """
+  Follows `url`'s redirects. Returns the final URL, the file's size (or None), whether it can be fetched in ranges,
+  and its SHA-256 if a redirect or the response said (like Hugging Face's X-Linked-Etag), or None.
+  `timeout` is how many seconds to wait for each server to respond.
+  """
+  opener = urllib.request.build_opener(NoRedirects)
+  sha256 = None
+
+  for _ in range(max_redirects):
+    try:
+      response = opener.open(urllib.request.Request(url, method="HEAD"), timeout=timeout)
+    except urllib.error.HTTPError as error:
+      if error.code not in (301, 302, 303, 307, 308):
+        raise
+      sha256 = sha256 or linked_sha256(error.headers)
+      url = urljoin(url, error.headers["Location"])
+      continue
+
+    with response:
+      sha256 = sha256 or linked_sha256(response.headers)
+      size = response.headers.get("Content-Length")
+      ranges = response.headers.get("Accept-Ranges") == "bytes"
+      return url, int(size) if size is not None else None, ranges, sha256
+
+  raise DownloadError(f"Too many redirects from {url}")
+
+
+def linked_sha256(headers):
+  # Hugging Face puts the SHA-256 of files stored with Git LFS in this header (other files get a shorter hash)
+  etag = (headers.get("X-Linked-Etag") or "").strip('W/"')
+  return etag.lower() if re.fullmatch(r"[0-9a-fA-F]{64}", etag) else None
+
+
+class Download:
+  """
+  Downloads a file over `connections` connections at once, a `piece_size` range at a time.
+
+  Pieces are written to `path`.part, and the pieces that are done are recorded in `path`.part.state,
+  so if it's interrupted, it picks up where it left off. Once every piece is done, the file's SHA-256
+  is checked (against `sha256`, or what the server says it is, if it does) before it's moved to `path`.
+
+  `progress` is called with how many bytes are done and how many there are (None if the server won't say).
+  If a connection goes `timeout` seconds without sending anything, its piece is tried again.
+  """
+
+  def __init__(self, url, path, connections=4, piece_size=16 * 1024**2, progress=None, sha256=None, retries=3,
+               timeout=60):
+    self.url = url
+    self.path = path
+    self.part_path = path + ".part"
+    self.state_path = self.part_path + ".state"
+    self.connections = connections
+    self.piece_size = piece_size
+    self.progress = progress
+    self.sha256 = sha256
+    self.retries = retries
+    self.timeout = timeout
+    self.lock = threading.Lock()
+    self.done = 0
+    # Set to stop the pieces that are being fetched (when one fails, or we're interrupted)
+    self.cancelled = threading.Event()
+
+  def run(self):
+    final_url, self.size, ranges, sha256 = resolve(self.url, timeout=self.timeout)
+    self.sha256 = (self.sha256 or sha256 or "").lower() or None
+
+    if self.size is None or not ranges:
+      # Without ranges, it can only be fetched whole (and starts over if it's interrupted)
+      self.fetch(final_url, 0, None)
+    else:
+      self.fetch_pieces(final_url)
+
+    if self.sha256 is not None and file_sha256(self.part_path) != self.sha256:
+      self.remove_partial_download()
+      raise DownloadError(f"{self.url} didn't match its SHA-256 ({self.sha256}), so it was deleted")
+
+    os.replace(self.part_path, self.path)
+    if os.path.exists(self.state_path):
+      os.remove(self.state_path)
+    return self.path
+
+  def fetch_pieces(self, url):
+    state = self.load_state()
+    done_pieces = set(state["pieces"])
+    pieces = [start for start in range(0, self.size, self.piece_size) if start not in done_pieces]
+    self.done = self.size - sum(min(self.piece_size, self.size - start) for start in pieces)
+    self.report_progress(0)
+
+    # Each piece is written where it goes in the file
+    if not os.path.exists(self.part_path) or os.path.getsize(self.part_path) != self.size:
+      with open(self.part_path, "wb") as f:
+        f.truncate(self.size)
+
+    def fetch_piece(start):
+      self.fetch(url, start, min(start + self.piece_size, self.size) - 1)
+      with self.lock:
+        state["pieces"].append(start)
+        self.save_state(state)
+
+    executor = ThreadPoolExecutor(self.connections)
+    try:
+      futures = [executor.submit(fetch_piece, start) for start in pieces]
+      done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+      for future in done:
+        future.result()
+    finally:
+      self.cancelled.set()
+      executor.shutdown(cancel_futures=True)
+
+  def fetch(self, url, start, end):
+    """
+    Writes bytes `start` to `end` (inclusive, or to the end of the file if it's None) of `url` into the .part file,
+    trying again (from `start`) if the connection fails.
+    """
+    for attempt in range(self.retries + 1):
+      written = 0
+      try:
+        request = urllib.request.Request(url)
+        if end is not None:
+          request.add_header("Range", f"bytes={start}-{end}")
+
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+          if end is not None and response.status != 206:
+            raise DownloadError(f"{url} didn't return the range we asked for")
+
+          with open(self.part_path, "r+b" if end is not None else "wb") as f:
+            f.seek(start)
+            for data in iter(lambda: response.read(1024**2), b""):
+              if self.cancelled.is_set():
+                raise DownloadError("Cancelled")
+              f.write(data)
+              written += len(data)
+              self.report_progress(len(data))
+
+        if end is not None and written != end - start + 1:
+          raise DownloadError(f"{url} ended early")
+        return
+
+      except (urllib.error.URLError, ConnectionError, TimeoutError, DownloadError) as error:
+        # What this attempt wrote will be written again
+        self.report_progress(-written)
+        if (attempt == self.retries or self.cancelled.is_set()
+            or (isinstance(error, urllib.error.HTTPError) and error.code < 500)):
+          raise
+        time.sleep(2 ** attempt)
+
+  def report_progress(self, size):
+    with self.lock:
+      self.done += size
+      if self.progress:
+        self.progress(self.done, self.size)
+
+  def load_state(self):
+    """
+    Returns which pieces of the .part file are done, if it's a download of this same file. Otherwise, none are.
+    """
+    state = {"url": self.url, "size": self.size, "piece_size": self.piece_size, "sha256": self.sha256, "pieces": []}
+    try:
+      with open(self.state_path) as f:
+        saved = json.load(f)
+    except (OSError, ValueError):
+      return state
+
+    same_download = all(saved.get(key) == state[key] for key in ["url", "size", "piece_size", "sha256"])
+    if same_download and os.path.exists(self.part_path) and os.path.getsize(self.part_path) == self.size:
+      state["pieces"] = saved.get("pieces", [])
+    return state
+
+  def save_state(self, state):
+    # Replaced all at once, so it's never half written
+    with open(self.state_path + ".tmp", "w") as f:
+      json.dump(state, f)
+    os.replace(self.state_path + ".tmp", self.state_path)
+
+  def remove_partial_download(self):
+    for path in [self.part_path, self.state_path]:
+      if os.path.exists(path):
+        os.remove(path)
+
+
+def download(url, path, **options):
+  """
+  Downloads `url` to `path`, resuming from a partial download if there's one (see Download for the `options`).
+  """
+  return Download(url, path, **options).run()
+
+
+def file_sha256(path):
+  sha256 = hashlib.sha256()
+  with open(path, "rb") as f:
+    for data in iter(lambda: f.read(1024**2), b""):
+      sha256.update(data)
+  return sha256.hexdigest()
@@ -0,0 +1,72 @@
+from .utils import Fragments
+
+
+class HeadlessMessageBlock:
+  """
+  Stands in for a MessageBlock when Open Interpreter runs headless.
+
+  Instead of drawing the message, it emits what's new as `message_delta` events.
+  """
+
+  def __init__(self, emit):
+    self.emit = emit
+    self.content = ""
+
+  def add_content(self, delta):
+    """
+    Emits the content that just streamed in.
+    """
+    if delta:
+      self.emit({"type": "message_delta", "content": delta})
+
+  def refresh(self, cursor=True):
+    pass
+
+  def end(self):
+    pass
+
+
+class HeadlessCodeBlock:
+  """
+  Stands in for a CodeBlock when Open Interpreter runs headless.
+
+  Instead of drawing the code, it emits what's new as `code_delta` events.
+  Code Interpreters still set its output and active line, which it keeps for the final message.
+  """
+
+  def __init__(self, emit):
+    self.emit = emit
+    self.language = ""
+    self.output = ""
+    self.code_pieces = Fragments()
+    self.active_line = None
+    # Code that streamed in before we knew its language
+    self.unsent = []
+
+  @property
+  def code(self):
+    return self.code_pieces.text()
+
+  @code.setter
+  def code(self, code):
+    self.code_pieces = Fragments([code])
+
+  def add_code(self, language, delta):
+    """
+    Emits the code that just streamed in.
+    """
+    self.language = language
+    self.code_pieces.append(delta)
+    self.unsent.append(delta)
+
+    if self.language:
+      content = "".join(self.unsent)
+      self.unsent = []
+      if content:
+        self.emit({"type": "code_delta", "language": self.language, "content": content})
+
+  def refresh(self, cursor=True):
+    pass
+
+  def end(self):
+    pass
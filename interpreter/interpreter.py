@@ -1,6 +1,11 @@
 # ------------------------------------------------------------------------------Imports
 import os
 import time
+import asyncio
+import copy
+import tempfile
+import queue
+import threading
 # import json
 import platform
 # import openai
@@ -8,17 +13,20 @@ import getpass
 # import requests
 import readline
 # import urllib.parse
-import tokentrim as tt
+from tokentrim.model_map import MODEL_MAX_TOKENS
 from rich import print
 from rich.markdown import Markdown
 from rich.rule import Rule
 
 # ------------------------------------------------------------------------------Local Files
 from .cli import cli
-from .utils import merge_deltas #, parse_partial_json
+from .utils import merge_deltas, MessageBuffer, PartialJSONParser, CodeFenceTracker
 from .message_block import MessageBlock
 from .code_block import CodeBlock
-from .code_interpreter import CodeInterpreter
+from .headless_block import HeadlessMessageBlock, HeadlessCodeBlock
+from .code_interpreter import CodeInterpreter, language_map
+from .token_ledger import TokenLedger, llm_tokenizer
+from .compaction import Compactor, first_user_message
 from .llama_2 import get_llama_2_instance
 from .hugchat import HugChat
 
@@ -39,6 +47,17 @@ class Interpreter:
         self.model = "gpt-4"
         self.debug_mode = False
 
+        # How many frames per second code and message blocks are drawn at
+        self.render_fps = 30
+
+        # Headless mode draws nothing on the terminal. Instead, `event_callback` is called with
+        # events (dicts with a "type") as messages stream in and code runs
+        self.headless = False
+        self.event_callback = None
+
+        # How many times code can be run in response to one message (None means no limit)
+        self.max_steps = None
+
         # Get default system message
         here = os.path.abspath(os.path.dirname(__file__))
         with open(os.path.join(here, 'system_message.txt'), 'r') as f:
@@ -56,6 +75,76 @@ class Interpreter:
         # This makes gpt-4 better aligned with Open Interpreters priority to be easy to use.
         self.llama_instance = None
 
+        # Sessions that share a llama_instance share this lock too, so one generates at a time
+        self.llama_lock = threading.Lock()
+
+        # Set to stop the current response (between chunks, or before running more code),
+        # like when a stream_chat is abandoned. Each response gets a new one
+        self.cancelled = threading.Event()
+
+        # The thread the last stream_chat's response ran in
+        self.stream_thread = None
+
+        # Where code runs. None means our own working directory
+        self.working_directory = None
+        # Whether create_session made it (so it can be removed when the session ends)
+        self.made_working_directory = False
+
+        # How to start and run code in each language (sessions each get their own copy)
+        self.language_map = language_map
+
+        # Where Code Interpreters get started processes from, if set (see ProcessPool)
+        self.process_pool = None
+
+        # Counts tokens to trim messages to the context window with (see TokenLedger).
+        # `tokenize` turns text into tokens. If it's None, the LLM's own is used if it has one, or else tiktoken's
+        self.token_ledger = TokenLedger()
+        self.tokenize = None
+
+        # How many tokens the LLM's prompt and response can have between them.
+        # If it's None, the LLM's own (like the one the local loader chose for the memory we have) is used
+        self.context_window = None
+
+        # Summarizes old code output and assistant messages once the conversation nears the context window.
+        # Set `compactor.summarize` to change how (see Compactor), or `compactor` to None to only trim
+        self.compactor = Compactor(self.token_ledger)
+
+    def create_session(self, working_directory=None, **settings):
+        """
+        Creates an Interpreter with the same settings (and LLM) as this one,
+        but its own messages, Code Interpreters and working directory.
+
+        Sessions don't share state, so each can be used from its own thread.
+        Without a `working_directory`, a new temporary directory is made.
+        `settings` are set on the session (e.g. `auto_run=True`).
+        """
+        session = Interpreter()
+
+        for attribute in ["temperature", "api_key", "auto_run", "local", "model", "debug_mode",
+                          "render_fps", "headless", "max_steps", "system_message",
+                          "llama_instance", "llama_lock", "process_pool", "tokenize", "context_window"]:
+            setattr(session, attribute, getattr(self, attribute))
+
+        session.language_map = copy.deepcopy(self.language_map)
+
+        if self.compactor is None:
+            session.compactor = None
+        else:
+            session.compactor.summarize = self.compactor.summarize
+
+        if working_directory is None:
+            working_directory = tempfile.mkdtemp(prefix="open-interpreter-")
+            session.made_working_directory = True
+        os.makedirs(working_directory, exist_ok=True)
+        session.working_directory = os.path.abspath(working_directory)
+
+        for attribute, value in settings.items():
+            if not hasattr(session, attribute):
+                raise AttributeError(f"Interpreter has no setting called '{attribute}'")
+            setattr(session, attribute, value)
+
+        return session
+
     def cli(self):
         # The cli takes the current instance of Interpreter,
         # modifies it according to command line flags, then runs chat.
@@ -70,7 +159,7 @@ class Interpreter:
 
         # Add user info
         username = getpass.getuser()
-        current_working_directory = os.getcwd()
+        current_working_directory = self.working_directory or os.getcwd()
         operating_system = platform.system()
 
         info += f"[User Info]\nName: {username}\nCWD: {current_working_directory}\nOS: {operating_system}"
@@ -89,31 +178,18 @@ class Interpreter:
     def load(self, messages):
         self.messages = messages
 
-    def chat(self, message=None, return_messages=False):
+    def chat(self, message=None, return_messages=False, stream=False):
 
-        # Connect to an LLM (a large language model)
-        self.verify_api_key()
+        # Stream events instead of displaying anything
+        if stream:
+            if message is None:
+                raise ValueError("chat(stream=True) needs a message to respond to.")
+            return self.stream_chat(message)
 
-        # ^ verify_api_key may set self.local to True, so we run this as an 'if', not 'elif':
-        if self.local:
-            self.model = "code-llama"
+        self.start_new_response()
 
-            # Code-Llama
-            if self.llama_instance is None:
-
-                # Find or install Code-Llama
-                try:
-                    self.llama_instance = HugChat.get_hugchat_instance()
-                except:
-                    # If it didn't work, apologize and switch to GPT-4
-
-                    print(Markdown("".join([
-                        "> Failed to install `Code-LLama`.",
-                        "\n\n**We have likely not built the proper `Code-Llama` support for your system.**",
-                        "\n\n*( Running language models locally is a difficult task!* If you have insight into the best way to implement this across platforms/architectures, please join the Open Interpreter community Discord and consider contributing the project's development. )",
-                        "\n\nPlease press enter to switch to `GPT-4` (recommended)."
-                    ])))
-                    input()
+        # Connect to an LLM (a large language model)
+        self.connect()
 
         # Display welcome message
         welcome_message = ""
@@ -138,7 +214,7 @@ class Interpreter:
 
         # Print welcome message with newlines on either side (aesthetic choice)
         # unless we're starting with a blockquote (aesthetic choice)
-        if welcome_message != "":
+        if welcome_message != "" and not self.headless:
             if welcome_message.startswith(">"):
                 print(Markdown(welcome_message), '')
             else:
@@ -187,14 +263,156 @@ class Interpreter:
         if return_messages:
             return self.messages
 
+    def stream_chat(self, message):
+        """
+        Responds to `message`, yielding the events headless mode sends to `event_callback`
+        as they happen, rather than displaying them.
+
+        The response runs in a thread that fills a queue, which we yield from.
+        If you stop iterating, the response is cancelled.
+        """
+        events = queue.Queue()
+        end_of_stream = object()
+        errors = []
+
+        # Once an abandoned stream's response has stopped, these are what it found them as
+        self.start_new_response()
+        cancelled = self.cancelled
+
+        headless, event_callback = self.headless, self.event_callback
+        self.headless = True
+        self.event_callback = events.put
+
+        def respond_in_background():
+            try:
+                self.connect()
+                self.messages.append({"role": "user", "content": message})
+                self.respond()
+            except BaseException as error:
+                errors.append(error)
+            finally:
+                self.end_active_block()
+                self.headless, self.event_callback = headless, event_callback
+                events.put(end_of_stream)
+
+        self.stream_thread = threading.Thread(target=respond_in_background, daemon=True)
+        self.stream_thread.start()
+
+        finished = False
+        try:
+            while True:
+                event = events.get()
+                if event is end_of_stream:
+                    finished = True
+                    break
+                yield event
+        finally:
+            if not finished:
+                # The caller stopped early, so the response stops too
+                # (and puts back headless and event_callback once it has)
+                cancelled.set()
+
+        if errors:
+            raise errors[0]
+
+    def start_new_response(self):
+        """
+        Gives the response we're starting its own `cancelled`, once any abandoned stream_chat's response
+        (which stops at its next chunk or step) is done with this Interpreter.
+        """
+        thread = self.stream_thread
+        if thread is not None and thread.is_alive() and thread is not threading.current_thread():
+            if not self.cancelled.is_set():
+                raise RuntimeError("This Interpreter is still responding to a streamed message.")
+            thread.join()
+
+        self.cancelled = threading.Event()
+
+    async def achat(self, message, return_messages=False):
+        """
+        Responds to `message` like chat(message), for use with asyncio.
+        """
+        # (An abandoned stream's response stops soon, so waiting for it doesn't hold up the event loop for long)
+        self.start_new_response()
+
+        # Connecting might load a model, so it happens off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.connect)
+
+        self.messages.append({"role": "user", "content": message})
+
+        try:
+            await self.arespond()
+        finally:
+            # Always end the active block. Multiple Live displays = issues
+            self.end_active_block()
+
+        if return_messages:
+            return self.messages
+
+    def connect(self):
+        """
+        Connects to an LLM (a large language model), loading Code-Llama if we're running locally.
+        """
+        self.verify_api_key()
+
+        # ^ verify_api_key may set self.local to True, so we run this as an 'if', not 'elif':
+        if self.local:
+            self.model = "code-llama"
+
+            # Code-Llama
+            if self.llama_instance is None:
+
+                # Find or install Code-Llama
+                try:
+                    self.llama_instance = HugChat.get_hugchat_instance()
+                except:
+                    if self.headless:
+                        raise
+
+                    # If it didn't work, apologize and switch to GPT-4
+
+                    print(Markdown("".join([
+                        "> Failed to install `Code-LLama`.",
+                        "\n\n**We have likely not built the proper `Code-Llama` support for your system.**",
+                        "\n\n*( Running language models locally is a difficult task!* If you have insight into the best way to implement this across platforms/architectures, please join the Open Interpreter community Discord and consider contributing the project's development. )",
+                        "\n\nPlease press enter to switch to `GPT-4` (recommended)."
+                    ])))
+                    input()
+
+            # Count tokens with Code-Llama's vocabulary, if we can
+            if self.tokenize is None:
+                self.tokenize = llm_tokenizer(self.llama_instance)
+
+            # Trim to the context window the model was loaded with
+            if self.context_window is None:
+                self.context_window = getattr(self.llama_instance, "context_window", None)
+
     def verify_api_key(self):
         """
         Configures the system to use the local model.
         """
         self.local = True
-        print(Markdown("> Switching to `Code-Llama`..."))
-        time.sleep(2)
-        print(Rule(style="white"))
+        if not self.headless:
+            print(Markdown("> Switching to `Code-Llama`..."))
+            time.sleep(2)
+            print(Rule(style="white"))
+
+    def emit(self, event):
+        """
+        Sends an event to `event_callback`, if there is one.
+        """
+        if self.event_callback:
+            self.event_callback(event)
+
+    def create_message_block(self):
+        if self.headless:
+            return HeadlessMessageBlock(self.emit)
+        return MessageBlock(self.render_fps)
+
+    def create_code_block(self):
+        if self.headless:
+            return HeadlessCodeBlock(self.emit)
+        return CodeBlock(self.render_fps)
 
     def end_active_block(self):
         if self.active_block:
@@ -202,6 +420,83 @@ class Interpreter:
             self.active_block = None
 
     def respond(self):
+        """
+        Runs the agent loop: streams a response from the LLM, runs the code it wrote,
+        then asks the LLM to respond to the output, until it stops writing code.
+
+        This is an explicit loop rather than recursion, so the stack depth stays constant
+        and earlier turns' response streams can be freed, however many steps a task takes.
+        """
+        state = "respond"
+        steps = 0
+
+        while state != "done":
+
+            if self.cancelled.is_set():
+                state = "done"
+
+            elif state == "respond":
+                response = self.get_response()
+                finished_function_call = self.stream_response(response)
+                response = None  # Let the finished stream go
+                state = "run_code" if finished_function_call else "done"
+
+            elif state == "run_code":
+                steps += 1
+                if not self.run_function_call():
+                    # User declined to run code
+                    state = "done"
+                elif self.reached_max_steps(steps):
+                    state = "done"
+                else:
+                    # Go around again
+                    state = "respond"
+
+    async def arespond(self):
+        """
+        Runs the agent loop like respond(), but on the running asyncio event loop.
+
+        Waiting on the LLM and on running code doesn't block the loop,
+        so one event loop can drive many Interpreters at once.
+        """
+        loop = asyncio.get_running_loop()
+        state = "respond"
+        steps = 0
+
+        while state != "done":
+
+            if self.cancelled.is_set():
+                state = "done"
+
+            elif state == "respond":
+                # Building the prompt counts (and trims) tokens, so it happens off the event loop
+                response = await loop.run_in_executor(None, self.get_response)
+                finished_function_call = await self.astream_response(response)
+                response = None  # Let the finished stream go
+                state = "run_code" if finished_function_call else "done"
+
+            elif state == "run_code":
+                steps += 1
+                if not await self.arun_function_call():
+                    # User declined to run code
+                    state = "done"
+                elif self.reached_max_steps(steps):
+                    state = "done"
+                else:
+                    # Go around again
+                    state = "respond"
+
+    def reached_max_steps(self, steps):
+        if self.max_steps is None or steps < self.max_steps:
+            return False
+        if not self.headless:
+            print('', Markdown(f"> Stopped after running code {steps} times (`max_steps` is {self.max_steps})."), '')
+        return True
+
+    def get_response(self):
+        """
+        Builds the messages (or prompt) for the LLM, then returns its response stream.
+        """
         # Add relevant info to system_message
         # (e.g. current working directory, username, os, etc.)
         info = self.get_info_for_system_message()
@@ -214,10 +509,24 @@ class Interpreter:
 
         system_message = self.system_message + "\n\n" + info
 
-        if self.local:
-            messages = tt.trim(self.messages, max_tokens=1048, system_message=system_message)
+        if self.tokenize is not None:
+            self.token_ledger.tokenize = self.tokenize
+
+        if self.local and self.context_window:
+            # Leave a quarter of it for the response, like tokentrim does for OpenAI's models
+            max_tokens = int(self.context_window * 0.75)
+        elif self.local:
+            max_tokens = 1048
         else:
-            messages = tt.trim(self.messages, self.model, system_message=system_message)
+            max_tokens = int(MODEL_MAX_TOKENS[self.model] * 0.75)
+
+        # Old outputs are summarized, rather than the oldest messages (like the task) being trimmed first
+        messages = self.messages
+        if self.compactor is not None:
+            messages = self.compactor.compact(messages, max_tokens, system_message)
+
+        # Only messages that are new (or have changed) since last time are tokenized
+        messages = self.token_ledger.trim(messages, max_tokens, system_message, pinned=first_user_message(messages))
 
         if self.debug_mode:
             print("\n", "Sending `messages` to LLM:", "\n")
@@ -278,196 +587,379 @@ class Interpreter:
 
             # Run Code-Llama
 
-            response = self.llama_instance(prompt)
+            response = self.generate(prompt)
             # print(str(type(response)) + " " + str(response))
 
+        return response
 
-        # Initialize message, function call trackers, and active block
-        self.messages.append({})
-        in_function_call = False
-        llama_function_call_finished = False
-        self.active_block = None
+    def generate(self, prompt):
+        """
+        Streams Code-Llama's response to `prompt`, holding llama_lock until it's done
+        (or the stream is closed), since sessions can share a llama_instance.
+        """
+        with self.llama_lock:
+            yield from self.llama_instance(prompt)
+
+    def stream_response(self, response):
+        """
+        Streams a response from the LLM into a new message, displaying it as it arrives.
+
+        Returns True if the response ended with a function call (code) we should run.
+        """
+        self.start_response()
 
         for chunk in response:
+            if self.cancelled.is_set():
+                break
+            finished_function_call = self.handle_chunk(chunk)
+            if finished_function_call is not None:
+                return finished_function_call
 
-            if self.local:
-                if "content" not in messages[-1]:
-                    # This is the first chunk. We'll need to capitalize it, because our prompt ends in a ", "
-                    chunk["choices"][0]["text"] = chunk["choices"][0]["text"].capitalize()
-                    # We'll also need to add "role: assistant", CodeLlama will not generate this
-                    messages[-1]["role"] = "assistant"
-                delta = {"content": chunk["choices"][0]["text"]}
-            else:
-                delta = chunk["choices"][0]["delta"]
+        return self.end_response()
 
-            # Accumulate deltas into the last message in messages
-            self.messages[-1] = merge_deltas(self.messages[-1], delta)
+    async def astream_response(self, response):
+        """
+        Like stream_response(), for arespond().
 
-            condition = False
-            if self.local:
-                # Since Code-Llama can't call functions, we just check if we're in a code block.
-                # This simply returns true if the number of "```" in the message is odd.
-                if "content" in self.messages[-1]:
-                    condition = self.messages[-1]["content"].count("```") % 2 == 1
-                else:
-                    # If it hasn't made "content" yet, we're certainly not in a function call.
-                    condition = False
+        Our LLMs hand back blocking iterators, so each response gets a thread of its own that reads it
+        and hands us the chunks through a queue. (Reading it in the default executor could deadlock:
+        with more sessions than pool threads, every thread would wait on llama_lock while the session
+        holding it waited for a thread.) Async iterators are read directly.
+        """
+        self.start_response()
 
-            if condition:
-                # We are in a function call.
+        if hasattr(response, "__aiter__"):
+            async for chunk in response:
+                if self.cancelled.is_set():
+                    break
+                finished_function_call = self.handle_chunk(chunk)
+                if finished_function_call is not None:
+                    return finished_function_call
 
-                # Check if we just entered a function call
-                if not in_function_call:
+        else:
+            loop = asyncio.get_running_loop()
+            chunks = asyncio.Queue()
+            end_of_response = object()
+            errors = []
+            stopped = threading.Event()
 
-                    # If so, end the last block,
-                    self.end_active_block()
+            def put(item):
+                try:
+                    loop.call_soon_threadsafe(chunks.put_nowait, item)
+                except RuntimeError:
+                    # The event loop is closed, so no one is waiting for it
+                    pass
 
-                    # Print newline if it was just a code block or user message
-                    # (this just looks nice)
-                    last_role = self.messages[-2]["role"]
-                    if last_role == "user" or last_role == "function":
-                        print()
+            def read_response():
+                stream = iter(response)
+                try:
+                    for chunk in stream:
+                        if stopped.is_set():
+                            break
+                        put(chunk)
+                except BaseException as error:
+                    errors.append(error)
+                finally:
+                    # Closing the stream releases llama_lock, if it's one of ours
+                    if hasattr(stream, "close"):
+                        stream.close()
+                    put(end_of_response)
+
+            threading.Thread(target=read_response, daemon=True).start()
+
+            try:
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is end_of_response or self.cancelled.is_set():
+                        break
+                    finished_function_call = self.handle_chunk(chunk)
+                    if finished_function_call is not None:
+                        return finished_function_call
+            finally:
+                # Stop reading if we returned early (or were cancelled)
+                stopped.set()
+
+            if errors:
+                raise errors[0]
+
+        return self.end_response()
+
+    def start_response(self):
+        # Initialize message, function call trackers, and active block
+        # (The message buffers streamed text, and is turned into a dict once it's complete)
+        self.messages.append(MessageBuffer())
+        self.in_function_call = False
+        self.llama_function_call_finished = False
+        self.arguments_parser = None
+        self.fence_tracker = CodeFenceTracker()
+        self.active_block = None
+
+    def handle_chunk(self, chunk):
+        """
+        Accumulates a chunk of the LLM's response into the last message, and displays it.
 
-                    # then create a new code block
-                    self.active_block = CodeBlock()
+        Returns None until the response is finished, then whether it ended with a function call we should run.
+        """
+        if self.local:
+            if "content" not in self.messages[-1]:
+                # This is the first chunk. We'll need to capitalize it, because our prompt ends in a ", "
+                chunk["choices"][0]["text"] = chunk["choices"][0]["text"].capitalize()
+                # We'll also need to add "role: assistant", CodeLlama will not generate this
+                self.messages[-1]["role"] = "assistant"
+            delta = {"content": chunk["choices"][0]["text"]}
+        else:
+            delta = chunk["choices"][0]["delta"]
+
+        # Accumulate deltas into the last message in messages
+        self.messages[-1] = merge_deltas(self.messages[-1], delta)
+
+        condition = False
+        if not self.local:
+            condition = "function_call" in self.messages[-1]
+        elif self.local:
+            # Since Code-Llama can't call functions, we just check if we're in a code block.
+            # The fence tracker only looks at each new token, so this doesn't slow down as the message grows.
+            fence_events = self.fence_tracker.feed(delta["content"])
+            condition = self.fence_tracker.in_code_block
+
+        if condition:
+            # We are in a function call.
+
+            # Check if we just entered a function call
+            if not self.in_function_call:
+
+                # If so, end the last block,
+                self.end_active_block()
+
+                # Print newline if it was just a code block or user message
+                # (this just looks nice)
+                last_role = self.messages[-2]["role"]
+                if (last_role == "user" or last_role == "function") and not self.headless:
+                    print()
+
+                # then create a new code block
+                self.active_block = self.create_code_block()
+
+                # and a parser for the arguments, which we'll feed as they stream in
+                self.arguments_parser = PartialJSONParser()
+
+            # Remember we're in a function_call
+            self.in_function_call = True
+
+            # Now let's parse the function's arguments:
+
+            if not self.local:
+                # gpt-4
+                # Only the new part of the arguments is parsed, so this stays cheap for long code
+                # (The decoded text is appended to parsed_arguments and the code block, not re-read whole)
+                new_arguments = delta.get("function_call", {}).get("arguments")
+                field_deltas = self.arguments_parser.feed(new_arguments) if new_arguments else {}
+                function_call = self.messages[-1]["function_call"]
+                if "parsed_arguments" not in function_call:
+                    function_call["parsed_arguments"] = MessageBuffer()
+                function_call["parsed_arguments"].merge(field_deltas)
+                self.active_block.add_code(self.arguments_parser.language, field_deltas.get("code", ""))
+
+            elif self.local:
+                # Code-Llama
+                # Code-Llama won't make a "function_call" property for us to store this under, so:
+                if "function_call" not in self.messages[-1]:
+                    self.messages[-1]["function_call"] = MessageBuffer(parsed_arguments=MessageBuffer(code=""))
+                parsed_arguments = self.messages[-1]["function_call"]["parsed_arguments"]
+
+                # Save the new code to parsed_arguments, under function_call
+                # (Only what changed, which the fence tracker tells us)
+                code_delta = ""
+                for event, data in fence_events:
+                    if event == "language":
+                        # We only add this once we have it-- the second we have it, an interpreter gets fired up (I think? maybe I'm wrong)
+                        parsed_arguments["language"] = data
+                    elif event == "code":
+                        parsed_arguments.merge({"code": data})
+                        code_delta += data
+                self.active_block.add_code(self.fence_tracker.language, code_delta)
 
-                # Remember we're in a function_call
-                in_function_call = True
+        else:
+            # We are not in a function call.
 
-                # Now let's parse the function's arguments:
+            # Check if we just left a function call
+            if self.in_function_call:
 
                 if self.local:
-                    # Code-Llama
-                    # Parse current code block and save to parsed_arguments, under function_call
-                    if "content" in self.messages[-1]:
+                    # This is the same as when gpt-4 gives finish_reason as function_call.
+                    # We have just finished a code block, so now we should run it.
+                    self.llama_function_call_finished = True
+
+                    # Without the whitespace and stray backticks around it
+                    # (and with its language, even if the fence closed on its first line)
+                    code = self.fence_tracker.code
+                    parsed_arguments = self.messages[-1]["function_call"]["parsed_arguments"]
+                    parsed_arguments["code"] = code
+                    parsed_arguments["language"] = self.fence_tracker.language
+                    self.active_block.language = self.fence_tracker.language
+                    self.active_block.code = code
+
+            # Remember we're not in a function_call
+            self.in_function_call = False
+
+            # If there's no active block,
+            if self.active_block is None:
+                # Create a message block, with what's been said so far
+                self.active_block = self.create_message_block()
+                self.active_block.add_content(self.messages[-1].get("content"))
+
+            # Otherwise, update it with what's new (unless it's the code block we just left)
+            elif not self.llama_function_call_finished:
+                self.active_block.add_content(delta.get("content"))
+
+        # Check if we're finished
+        if chunk["choices"][0]["finish_reason"] or self.llama_function_call_finished:
+            self.messages[-1] = self.messages[-1].to_dict()
+
+            if chunk["choices"][
+                0]["finish_reason"] == "function_call" or self.llama_function_call_finished:
+                # Time to call the function!
+                return True
+
+            # Done!
+
+            # Code Llama likes to output "###" at the end of every message for some reason
+            if self.local and "content" in self.messages[-1]:
+                self.messages[-1]["content"] = self.messages[-1]["content"].strip().rstrip("#")
+                self.active_block.content = self.messages[-1]["content"]
 
-                        content = self.messages[-1]["content"]
+            self.active_block.end()
+            return False
 
-                        if "```" in content:
-                            # Split by "```" to get the last open code block
-                            blocks = content.split("```")
+    def end_response(self):
+        # The stream ended without a finish_reason
+        if isinstance(self.messages[-1], MessageBuffer):
+            self.messages[-1] = self.messages[-1].to_dict()
+        return False
 
-                            current_code_block = blocks[-1]
+    def run_function_call(self):
+        """
+        Runs the code from the last message's function call, and appends its output to messages.
 
-                            lines = current_code_block.split("\n")
+        Returns False if the user declined to run it.
+        """
+        # (Because this is Open Interpreter, we only have one function.)
+        if not self.confirm_function_call():
+            return False
 
-                            if content.strip() == "```":  # Hasn't outputted a language yet
-                                language = None
-                            else:
-                                language = lines[0].strip() if lines[0] != "" else "python"
+        code_interpreter = self.start_function_call()
+        code_interpreter.run()
+        self.finish_function_call()
 
-                            # Join all lines except for the language line
-                            code = '\n'.join(lines[1:]).strip("` \n")
+        return True
 
-                            arguments = {"code": code}
-                            if language:  # We only add this if we have it-- the second we have it, an interpreter gets fired up (I think? maybe I'm wrong)
-                                arguments["language"] = language
+    async def arun_function_call(self):
+        """
+        Like run_function_call(), for arespond().
+        """
+        if self.auto_run or self.headless:
+            confirmed = self.confirm_function_call()
+        else:
+            # Asking the user blocks on input(), so it happens off the event loop
+            confirmed = await asyncio.get_running_loop().run_in_executor(None, self.confirm_function_call)
 
-                        # Code-Llama won't make a "function_call" property for us to store this under, so:
-                        if "function_call" not in self.messages[-1]:
-                            self.messages[-1]["function_call"] = {}
+        if not confirmed:
+            return False
 
-                        self.messages[-1]["function_call"]["parsed_arguments"] = arguments
+        code_interpreter = self.start_function_call()
+        await code_interpreter.arun()
+        self.finish_function_call()
 
-            else:
-                # We are not in a function call.
-
-                # Check if we just left a function call
-                if in_function_call:
-
-                    if self.local:
-                        # This is the same as when gpt-4 gives finish_reason as function_call.
-                        # We have just finished a code block, so now we should run it.
-                        llama_function_call_finished = True
-
-                # Remember we're not in a function_call
-                in_function_call = False
-
-                # If there's no active block,
-                if self.active_block is None:
-                    # Create a message block
-                    self.active_block = MessageBlock()
-
-            # Update active_block
-            self.active_block.update_from_message(self.messages[-1])
-
-            # Check if we're finished
-            if chunk["choices"][0]["finish_reason"] or llama_function_call_finished:
-                if chunk["choices"][
-                    0]["finish_reason"] == "function_call" or llama_function_call_finished:
-                    # Time to call the function!
-                    # (Because this is Open Interpreter, we only have one function.)
-
-                    if self.debug_mode:
-                        print("Running function:")
-                        print(self.messages[-1])
-                        print("---")
-
-                    # Ask for user confirmation to run code
-                    if not self.auto_run:
-
-                        # End the active block so you can run input() below it
-                        # Save language and code so we can create a new block in a moment
-                        self.active_block.end()
-                        language = self.active_block.language
-                        code = self.active_block.code
-
-                        # Prompt user
-                        response = input("  Would you like to run this code? (y/n)\n\n  ")
-                        print("")  # <- Aesthetic choice
-
-                        if response.strip().lower() == "y":
-                            # Create a new, identical block where the code will actually be run
-                            self.active_block = CodeBlock()
-                            self.active_block.language = language
-                            self.active_block.code = code
-
-                        else:
-                            # User declined to run code.
-                            self.active_block.end()
-                            self.messages.append({
-                                "role":
-                                    "function",
-                                "name":
-                                    "run_code",
-                                "content":
-                                    "User decided not to run this code."
-                            })
-                            return
-
-                    # Create or retrieve a Code Interpreter for this language
-                    language = self.messages[-1]["function_call"]["parsed_arguments"][
-                        "language"]
-                    if language not in self.code_interpreters:
-                        self.code_interpreters[language] = CodeInterpreter(language, self.debug_mode)
-                    code_interpreter = self.code_interpreters[language]
-
-                    # Let this Code Interpreter control the active_block
-                    code_interpreter.active_block = self.active_block
-                    code_interpreter.run()
-
-                    # End the active_block
-                    self.active_block.end()
-
-                    # Append the output to messages
-                    # Explicitly tell it if there was no output (sometimes "" = hallucinates output)
-                    self.messages.append({
-                        "role": "function",
-                        "name": "run_code",
-                        "content": self.active_block.output if self.active_block.output else "No output"
-                    })
+        return True
 
-                    # Go around again
-                    self.respond()
+    def confirm_function_call(self):
+        """
+        Asks the user whether to run the code (unless auto_run is set).
+        If they decline, that's added to messages and we return False.
+        """
+        # A cancelled response doesn't start anything new
+        if self.cancelled.is_set():
+            return False
 
-                if chunk["choices"][0]["finish_reason"] != "function_call":
-                    # Done!
+        if self.debug_mode:
+            print("Running function:")
+            print(self.messages[-1])
+            print("---")
+
+        # In headless mode there's no one to ask, so code only runs with auto_run
+        if not self.auto_run and self.headless:
+            self.messages.append({
+                "role": "function",
+                "name": "run_code",
+                "content": "User decided not to run this code."
+            })
+            return False
+
+        # Ask for user confirmation to run code
+        if not self.auto_run:
+
+            # End the active block so you can run input() below it
+            # Save language and code so we can create a new block in a moment
+            self.active_block.end()
+            language = self.active_block.language
+            code = self.active_block.code
+
+            # Prompt user
+            response = input("  Would you like to run this code? (y/n)\n\n  ")
+            print("")  # <- Aesthetic choice
 
-                    # Code Llama likes to output "###" at the end of every message for some reason
-                    if self.local and "content" in self.messages[-1]:
-                        self.messages[-1]["content"] = self.messages[-1]["content"].strip().rstrip("#")
-                        self.active_block.update_from_message(self.messages[-1])
-                        time.sleep(0.1)
+            if response.strip().lower() == "y":
+                # Create a new, identical block where the code will actually be run
+                self.active_block = self.create_code_block()
+                self.active_block.language = language
+                self.active_block.code = code
 
-                    self.active_block.end()
-                    return
+            else:
+                # User declined to run code.
+                self.active_block.end()
+                self.messages.append({
+                    "role":
+                        "function",
+                    "name":
+                        "run_code",
+                    "content":
+                        "User decided not to run this code."
+                })
+                return False
+
+        return True
+
+    def start_function_call(self):
+        """
+        Returns the Code Interpreter that will run the code, now controlling the active block.
+        """
+        # Create or retrieve a Code Interpreter for this language
+        language = self.messages[-1]["function_call"]["parsed_arguments"][
+            "language"]
+        if language not in self.code_interpreters:
+            self.code_interpreters[language] = CodeInterpreter(language, self.debug_mode, self.emit,
+                                                               self.language_map, self.working_directory,
+                                                               self.process_pool)
+        code_interpreter = self.code_interpreters[language]
+
+        # Let this Code Interpreter control the active_block
+        code_interpreter.active_block = self.active_block
+        self.emit({"type": "execution_started", "language": language, "code": self.active_block.code})
+
+        return code_interpreter
+
+    def finish_function_call(self):
+        """
+        Ends the active block and appends the code's output to messages.
+        """
+        # End the active_block
+        self.active_block.end()
+        self.emit({"type": "execution_finished", "language": self.active_block.language, "output": self.active_block.output})
+
+        # Append the output to messages
+        # Explicitly tell it if there was no output (sometimes "" = hallucinates output)
+        self.messages.append({
+            "role": "function",
+            "name": "run_code",
+            "content": self.active_block.output if self.active_block.output else "No output"
+        })
@@ -1,12 +1,14 @@
 import os
 import sys
-import wget
+import codecs
 import appdirs
 import inquirer
 import subprocess
 import contextlib
 from rich import print
 from rich.markdown import Markdown
+from rich.progress import Progress, BarColumn, DownloadColumn, TransferSpeedColumn, TimeRemainingColumn
+from .downloader import download
 
 
 def get_llama_2_instance():
@@ -83,7 +85,12 @@ def get_llama_2_instance():
         download_path = os.path.join(default_path, file_name)
         message = f"This instance of `Code-Llama` was not found. Would you like to download it?"
         if confirm_action(message):
-            wget.download(url, download_path)
+            # In parallel, and if it's interrupted, it carries on from where it left off next time
+            columns = [BarColumn(), DownloadColumn(), TransferSpeedColumn(), TimeRemainingColumn()]
+            with Progress(*columns) as progress_bar:
+                task = progress_bar.add_task("Downloading", total=None)
+                download(url, download_path,
+                         progress=lambda done, total: progress_bar.update(task, completed=done, total=total))
             model_path = download_path
             print('\n', "Finished downloading `Code-Llama`.", '\n')
         else:
@@ -172,10 +179,153 @@ def get_llama_2_instance():
             print('', "Installation cancelled. Exiting.", '')
             return None
 
+    # Choose the largest context window that fits in memory, next to the model (smaller is faster)
+    n_ctx = choose_context_window(os.path.getsize(model_path), kv_cache_bytes_per_token[chosen_param])
+    print('', Markdown(f"Using a context window of {n_ctx} tokens."), '')
+
     # Initialize and return Code-Llama
-    llama_2 = Llama(model_path=model_path, n_gpu_layers=n_gpu_layers, verbose=False, n_ctx=1048) # n_ctx = context window. smaller is faster
+    llama_2 = Llama(model_path=model_path, n_gpu_layers=n_gpu_layers, verbose=False, n_ctx=n_ctx)
       
-    return llama_2
+    return PrefixCachingLlama(llama_2)
+
+
+# How much memory the KV cache takes per token of context (2 (keys and values) x layers x KV dimensions x 2 bytes (f16)).
+# 34B uses grouped-query attention, so it has 8 KV heads (1024 dimensions) where the others have one per head
+kv_cache_bytes_per_token = {
+    '7B': 2 * 32 * 4096 * 2,
+    '13B': 2 * 40 * 5120 * 2,
+    '34B': 2 * 48 * 1024 * 2
+}
+
+
+def available_memory():
+    """
+    Returns how many bytes of memory are available, or None if we can't tell.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def choose_context_window(model_size, kv_bytes_per_token, memory=None,
+                          minimum=512, maximum=16384, default=1048, overhead=512 * 1024**2):
+    """
+    Returns the largest context window (a multiple of 256 tokens, from `minimum` to `maximum`, which is what
+    Code Llama was trained on) whose KV cache fits in `memory` (by default, what's available),
+    next to the model's weights (about its file size, whatever it's quantized to) and `overhead` for llama.cpp's buffers.
+
+    Returns `default` if we can't tell how much memory there is.
+    """
+    if memory is None:
+        memory = available_memory()
+    if memory is None:
+        return default
+
+    # Leave a tenth for everything else
+    spare = memory * 0.9 - model_size - overhead
+    n_ctx = int(spare // kv_bytes_per_token) // 256 * 256
+    return max(minimum, min(maximum, n_ctx))
+
+
+class PrefixCachingLlama:
+    """
+    Wraps a llama_cpp Llama so each prompt only evaluates what's changed since the last one.
+
+    Each turn's prompt is the whole conversation again, which Llama would evaluate from its first token.
+    Instead, the model's state (its KV cache) is kept for the longest prefix the prompt shares with
+    the tokens evaluated last time (the last prompt and the response to it), and only the rest is evaluated.
+    So time to first token depends on how much is new, not on how long the conversation is.
+
+    It's called with a prompt, and streams chunks like {"choices": [{"text": ..., "finish_reason": ...}]}.
+    """
+
+    def __init__(self, llama):
+        self.llama = llama
+        # How many tokens the prompt and response can have between them
+        self.context_window = llama.n_ctx()
+        # The tokens whose state is in the model's KV cache
+        self.tokens = []
+
+    def tokenize(self, text, add_bos=True):
+        return self.llama.tokenize(text, add_bos=add_bos)
+
+    def __call__(self, prompt, temperature=0.1, top_p=0.95, top_k=40, repeat_penalty=1.1, max_tokens=None, stop=["</s>"]):
+        tokens = self.llama.tokenize(prompt.encode())
+
+        # The prompt's last token is always evaluated, so there are logits to sample the first new token from
+        prefix = common_prefix_length(self.tokens, tokens[:-1])
+        self.llama.n_tokens = prefix
+        self.tokens = self.tokens[:prefix]
+
+        generated = []
+        # Tokens can end partway through a character
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        # Generated text we haven't streamed yet, because it might be the start of a stop sequence
+        text = ""
+        finish_reason = None
+
+        try:
+            for token in self.llama.generate(tokens[prefix:], top_k=top_k, top_p=top_p, temp=temperature,
+                                             repeat_penalty=repeat_penalty, reset=False):
+                if token == self.llama.token_eos():
+                    finish_reason = "stop"
+                    break
+
+                generated.append(token)
+                text += decoder.decode(self.llama.detokenize([token]))
+
+                stops = [text.index(sequence) for sequence in stop if sequence in text]
+                if stops:
+                    text = text[:min(stops)]
+                    finish_reason = "stop"
+                    break
+
+                ready = len(text) - max([stop_sequence_start(text, sequence) for sequence in stop], default=0)
+                if ready:
+                    yield completion_chunk(text[:ready])
+                    text = text[ready:]
+
+                if max_tokens is not None and len(generated) >= max_tokens:
+                    finish_reason = "length"
+                    break
+
+            yield completion_chunk(text, finish_reason)
+
+        finally:
+            # Whatever's been evaluated (the last token generated hasn't been, if we stopped after it)
+            self.tokens = (tokens + generated)[:self.llama.n_tokens]
+
+
+def common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def stop_sequence_start(text, sequence):
+    """
+    Returns the length of the longest start of `sequence` (but not all of it) that `text` ends with.
+    """
+    for length in range(min(len(sequence) - 1, len(text)), 0, -1):
+        if text.endswith(sequence[:length]):
+            return length
+    return 0
+
+
+def completion_chunk(text, finish_reason=None):
+    return {"choices": [{"text": text, "finish_reason": finish_reason}]}
 
 def confirm_action(message):
     question = [
@@ -3,55 +3,150 @@ from rich.live import Live
 from rich.panel import Panel
 from rich.markdown import Markdown
 from rich.box import MINIMAL
+from markdown_it import MarkdownIt
 import re
+from .render_scheduler import RenderScheduler
+from .utils import Fragments
 
 
 class MessageBlock:
 
-  def __init__(self):
+  def __init__(self, fps=30):
     self.live = Live(auto_refresh=False, console=Console())
     self.live.start()
-    self.content = ""
+    self.content_pieces = Fragments()
+    self.cursor = True
 
-  def update_from_message(self, message):
-    self.content = message.get("content", "")
-    if self.content:
+    # Finished markdown blocks are parsed once, and their tokens are reused on every frame
+    self.frozen_content = ""
+    self.frozen_tokens = []
+    # Until we see a reference-style link definition
+    self.freezing = True
+    # How much of the content was parsed for finished blocks last time
+    self.parsed_length = 0
+
+    # Refreshes happen on every token, so we only draw `fps` frames per second
+    self.render_scheduler = RenderScheduler(self.render, fps)
+
+  @property
+  def content(self):
+    # Joined when a frame is drawn, not on every token
+    return self.content_pieces.text()
+
+  @content.setter
+  def content(self, content):
+    self.content_pieces = Fragments([content])
+    self.refresh()
+
+  def add_content(self, delta):
+    """
+    Appends the content that just streamed in.
+    """
+    if delta:
+      self.content_pieces.append(delta)
       self.refresh()
 
+  @property
+  def dropped_frames(self):
+    return self.render_scheduler.dropped_frames
+
   def end(self):
-    self.refresh(cursor=False)
+    # Draw the final frame
+    self.cursor = False
+    self.render_scheduler.close()
     self.live.stop()
 
   def refresh(self, cursor=True):
-    # De-stylize any code blocks in markdown,
-    # to differentiate from our Code Blocks
-    content = textify_markdown_code_blocks(self.content)
-    
+    self.cursor = cursor
     if cursor:
-      content += "█"
-      
-    markdown = Markdown(content.strip())
-    panel = Panel(markdown, box=MINIMAL)
+      self.render_scheduler.request()
+    else:
+      self.render_scheduler.flush()
+
+  def render(self):
+    panel = Panel(self.markdown(), box=MINIMAL)
     self.live.update(panel)
     self.live.refresh()
 
+  def markdown(self):
+    content = self.content
 
-def textify_markdown_code_blocks(text):
-  """
-  To distinguish CodeBlocks from markdown code, we simply turn all markdown code
-  (like '```python...') into text code blocks ('```text') which makes the code black and white.
-  """
-  replacement = "```text"
-  lines = text.split('\n')
-  inside_code_block = False
+    # Parse any markdown blocks that were finished since the last frame
+    self.freeze_finished_blocks(content)
+    content = content[len(self.frozen_content):]
+
+    if self.cursor:
+      content += "█"
+
+    # Only the open tail is parsed again, then rendered after the finished blocks
+    markdown = Markdown(content.strip())
+    markdown.parsed = self.frozen_tokens + textify_code_blocks(markdown.parsed)
+    return markdown
+
+  def freeze_finished_blocks(self, content):
+    """
+    Parses markdown blocks (paragraphs, lists, code fences) that can't change anymore.
+
+    The tail's complete lines are parsed like rich parses them, and every top-level block but the last
+    is finished: the lines after it already started another block.
+    """
+    # If the content was rewritten, not just added to, start over
+    if not content.startswith(self.frozen_content):
+      self.frozen_content = ""
+      self.frozen_tokens = []
+      self.parsed_length = 0
+    if not self.freezing:
+      return
+
+    tail = content[len(self.frozen_content):]
+    # The last line might still be streaming
+    complete = tail[:tail.rfind("\n") + 1]
+    if reference_definition.match(tail[len(complete):]):
+      self.stop_freezing()
+      return
+
+    # Nothing changes until another line is complete
+    if len(self.frozen_content) + len(complete) == self.parsed_length:
+      return
+    self.parsed_length = len(self.frozen_content) + len(complete)
+
+    env = {}
+    tokens = markdown_parser.parse(complete, env)
+    if env.get("references"):
+      self.stop_freezing()
+      return
+
+    starts = [i for i, token in enumerate(tokens) if token.level == 0 and token.map is not None]
+    if len(starts) < 2:
+      return
 
-  for i in range(len(lines)):
-    # If the line matches ``` followed by optional language specifier
-    if re.match(r'^```(\w*)$', lines[i].strip()):
-      inside_code_block = not inside_code_block
+    # The last block starts on this line (counting lines the way markdown-it splits them)
+    last_line = tokens[starts[-1]].map[0]
+    newlines = list(re.finditer(r"\r\n?|\n", complete))
+    self.frozen_content += complete[:newlines[last_line - 1].end()]
+    self.frozen_tokens += textify_code_blocks(tokens[:starts[-1]])
 
-      # If we just entered a code block, replace the marker
-      if inside_code_block:
-        lines[i] = replacement
+  def stop_freezing(self):
+    # Reference-style links resolve against definitions anywhere in the message,
+    # so from now on it's all parsed together
+    self.freezing = False
+    self.frozen_content = ""
+    self.frozen_tokens = []
 
-  return '\n'.join(lines)
+
+# The start of a line like "[docs]: https://example.com"
+reference_definition = re.compile(r" {0,3}\[[^\]]+\]:")
+
+# Configured like rich's Markdown, so frozen tokens are the same as the ones it would parse
+markdown_parser = MarkdownIt().enable("strikethrough").enable("table")
+
+
+def textify_code_blocks(tokens):
+  """
+  To distinguish CodeBlocks from markdown code, we simply turn all markdown code
+  (like '```python...' or '~~~ js title=x') into text code blocks, which makes the code black and white.
+  """
+  for token in tokens:
+    if token.type == "fence":
+      token.info = "text"
+  return tokens
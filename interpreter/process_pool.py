@@ -0,0 +1,124 @@
+import subprocess
+import threading
+import platform
+import os
+import weakref
+
+
+def spawn_process(start_cmd, working_directory=None):
+  """
+  Starts a process for a Code Interpreter to write code to, and read output from.
+  Its pipes are binary. Code Interpreters encode what they write, and decode what they read.
+
+  Except on Windows, the process also gets the write end of a control pipe
+  (`child_control_fd` in the process, also in its OI_CONTROL_FD environment variable)
+  that we read from `control_fd`.
+  """
+  if platform.system() == "Windows":
+    proc = subprocess.Popen(start_cmd.split(),
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            cwd=working_directory)
+    proc.control_fd = proc.child_control_fd = None
+    return proc
+
+  control_fd, child_control_fd = os.pipe()
+  try:
+    proc = subprocess.Popen(start_cmd.split(),
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            cwd=working_directory,
+                            pass_fds=(child_control_fd,),
+                            env=dict(os.environ, OI_CONTROL_FD=str(child_control_fd)))
+  except:
+    os.close(control_fd)
+    raise
+  finally:
+    # Only the process writes to it
+    os.close(child_control_fd)
+
+  proc.control_fd = control_fd
+  proc.child_control_fd = child_control_fd
+  # Like its other pipes, this is closed once the process is let go of
+  weakref.finalize(proc, os.close, control_fd)
+  return proc
+
+
+class ProcessPool:
+  """
+  Keeps `size` processes started for each start command, so Code Interpreters
+  don't wait for an interpreter (like `python -i`) to start up on their first run.
+
+  A process is handed out once, then replaced in the background. Processes are never
+  handed out again after use, since they hold the last session's variables.
+  """
+
+  def __init__(self, size=1):
+    self.size = size
+    self.ready = {}
+    # How many processes are being started for each start command
+    self.starting = {}
+    self.closed = False
+    self.lock = threading.Lock()
+
+  def acquire(self, start_cmd):
+    """
+    Returns a started process for `start_cmd`, starting one now if none are ready.
+    """
+    process = None
+
+    with self.lock:
+      ready = self.ready.setdefault(start_cmd, [])
+      while ready and process is None:
+        process = ready.pop(0)
+        # It might have died while it waited
+        if process.poll() is not None:
+          process = None
+
+    self.warm(start_cmd)
+
+    if process is None:
+      process = spawn_process(start_cmd)
+    return process
+
+  def warm(self, start_cmd):
+    """
+    Starts processes for `start_cmd` in the background, until `size` are ready.
+    """
+    threading.Thread(target=self.fill, args=(start_cmd,), daemon=True).start()
+
+  def fill(self, start_cmd):
+    while True:
+      with self.lock:
+        ready = self.ready.setdefault(start_cmd, [])
+        if self.closed or len(ready) + self.starting.get(start_cmd, 0) >= self.size:
+          return
+        self.starting[start_cmd] = self.starting.get(start_cmd, 0) + 1
+
+      try:
+        process = spawn_process(start_cmd)
+      except OSError:
+        # Like if they don't have `node` installed. The Code Interpreter will report that itself
+        process = None
+
+      with self.lock:
+        self.starting[start_cmd] -= 1
+        if process is None:
+          return
+        if self.closed:
+          process.kill()
+          return
+        ready.append(process)
+
+  def close(self):
+    """
+    Kills the processes that are waiting to be handed out.
+    """
+    with self.lock:
+      self.closed = True
+      for ready in self.ready.values():
+        for process in ready:
+          process.kill()
+      self.ready = {}
@@ -0,0 +1,257 @@
+"""
+A small kernel that Code Interpreters run Python code with (see language_map in code_interpreter.py).
+
+It reads messages like {"code": "..."} from stdin, runs the code in a namespace that's kept between
+messages, and writes messages back to the control pipe (its fd is in OI_CONTROL_FD):
+
+  {"type": "stdout", "text": "..."}      something the code wrote to sys.stdout (see PendingOutput)
+  {"type": "stderr", "text": "..."}      ...or to sys.stderr (like a traceback)
+  {"type": "active_line", "line": 3}     the line that's running (see LineSampler)
+  {"type": "done"}                       the code has finished (unless the message had "reply": false)
+
+Each message is framed as a 4 byte big-endian length, then that many bytes of JSON.
+
+This runs on its own (not as part of the interpreter package), so it only uses the standard library.
+"""
+
+import builtins
+import codecs
+import io
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import types
+
+control_fd = int(os.environ["OI_CONTROL_FD"])
+
+# Code can print from many threads at once
+send_lock = threading.Lock()
+
+
+def send(message):
+  data = json.dumps(message).encode()
+  data = len(data).to_bytes(4, "big") + data
+  with send_lock:
+    while data:
+      data = data[os.write(control_fd, data):]
+
+
+def receive(stream):
+  """
+  Returns the next message from `stream`, or None once it's closed.
+  """
+  header = read_exactly(stream, 4)
+  if header is None:
+    return None
+  return json.loads(read_exactly(stream, int.from_bytes(header, "big")))
+
+
+def read_exactly(stream, size):
+  data = b""
+  while len(data) < size:
+    chunk = stream.read(size - len(data))
+    if not chunk:
+      return None
+    data += chunk
+  return data
+
+
+class PendingOutput:
+  """
+  Collects what code writes to sys.stdout and sys.stderr, so it's sent as a few large messages
+  rather than one per write. It's sent when `max_size` characters are waiting, when code flushes,
+  on every LineSampler tick, and when the code's done.
+  """
+
+  def __init__(self, max_size=65536):
+    self.max_size = max_size
+    self.parts = []
+    self.size = 0
+    self.lock = threading.Lock()
+
+  def add(self, name, text):
+    with self.lock:
+      # Consecutive writes to the same stream go in one message
+      if self.parts and self.parts[-1][0] == name:
+        self.parts[-1][1].append(text)
+      else:
+        self.parts.append((name, [text]))
+      self.size += len(text)
+
+      if self.size >= self.max_size:
+        self.send()
+
+  def flush(self):
+    with self.lock:
+      self.send()
+
+  def send(self):
+    for name, texts in self.parts:
+      send({"type": name, "text": "".join(texts)})
+    self.parts = []
+    self.size = 0
+
+
+pending_output = PendingOutput()
+
+
+class FramedStream(io.TextIOBase):
+  """
+  Stands in for sys.stdout or sys.stderr, sending what's written as messages.
+
+  It looks like the stream it replaces: it has an encoding, a `buffer` for bytes, and the real
+  file descriptor (for subprocesses and faulthandler), whose output reaches the Code Interpreter
+  through the process's own pipes.
+  """
+
+  encoding = "utf-8"
+  errors = "strict"
+
+  def __init__(self, name, fd):
+    self.name = name
+    self.fd = fd
+    self.buffer = FramedBuffer(self)
+
+  def writable(self):
+    return True
+
+  def write(self, text):
+    if text:
+      pending_output.add(self.name, text)
+    return len(text)
+
+  def flush(self):
+    pending_output.flush()
+
+  def fileno(self):
+    # What's written to the descriptor directly comes after what we were given
+    self.flush()
+    return self.fd
+
+
+class FramedBuffer(io.RawIOBase):
+  """
+  The `buffer` of a FramedStream, for code that writes bytes (like sys.stdout.buffer.write(b"...")).
+  """
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+
+  def writable(self):
+    return True
+
+  def write(self, data):
+    self.stream.write(self.decoder.decode(bytes(data)))
+    return len(data)
+
+  def flush(self):
+    self.stream.flush()
+
+  def fileno(self):
+    return self.stream.fileno()
+
+
+class LineSampler(threading.Thread):
+  """
+  While code runs, checks which of its lines is running `rate` times a second,
+  and sends it when it's changed.
+
+  Sampling costs the same however fast the code runs through its lines,
+  where reporting every line would slow down tight loops.
+  """
+
+  def __init__(self, thread_id, rate=30):
+    super().__init__(daemon=True)
+    self.thread_id = thread_id
+    self.interval = 1 / rate
+    self.running = threading.Event()
+    self.lock = threading.Lock()
+    self.line = None
+
+  def start_sampling(self):
+    with self.lock:
+      self.line = None
+      self.running.set()
+
+  def stop_sampling(self):
+    # Once this returns, nothing else is sent for this run
+    with self.lock:
+      self.running.clear()
+
+  def run(self):
+    while True:
+      self.running.wait()
+      time.sleep(self.interval)
+      with self.lock:
+        if self.running.is_set():
+          pending_output.flush()
+          self.sample()
+
+  def sample(self):
+    # The innermost frame that's running the code we were sent (maybe in a function it defined)
+    frame = sys._current_frames().get(self.thread_id)
+    while frame is not None and frame.f_code.co_filename != "<stdin>":
+      frame = frame.f_back
+
+    if frame is not None and frame.f_lineno != self.line:
+      self.line = frame.f_lineno
+      send({"type": "active_line", "line": self.line})
+
+
+def run(code, namespace):
+  # Code can't read our messages. input() gets an EOFError instead
+  # (This is done before each run because exit() closes sys.stdin)
+  sys.stdin = io.StringIO()
+
+  try:
+    exec(compile(code, "<stdin>", "exec"), namespace)
+  except SystemExit as error:
+    # exit() ends the code, not the kernel (which would lose its namespace)
+    if isinstance(error.code, str):
+      print(error.code, file=sys.stderr)
+  except BaseException:
+    # Leave this frame out of the traceback
+    error_type, error, error_traceback = sys.exc_info()
+    traceback.print_exception(error_type, error, error_traceback.tb_next)
+
+
+def main():
+  stdin = sys.stdin.buffer
+
+  sys.stdout = FramedStream("stdout", 1)
+  sys.stderr = FramedStream("stderr", 2)
+
+  # Code sees what it would under `python -i`: no script, and imports from the working directory, not ours
+  sys.argv = [""]
+  if sys.path and sys.path[0] == os.path.dirname(os.path.abspath(__file__)):
+    sys.path[0] = ""
+
+  line_sampler = LineSampler(threading.get_ident())
+  line_sampler.start()
+
+  # The code's namespace is __main__, so things like pickle find what it defines
+  main_module = types.ModuleType("__main__")
+  main_module.__builtins__ = builtins
+  sys.modules["__main__"] = main_module
+  namespace = main_module.__dict__
+
+  while True:
+    message = receive(stdin)
+    if message is None:
+      break
+
+    line_sampler.start_sampling()
+    run(message["code"], namespace)
+    line_sampler.stop_sampling()
+    pending_output.flush()
+
+    if message.get("reply", True):
+      send({"type": "done"})
+
+
+if __name__ == "__main__":
+  main()
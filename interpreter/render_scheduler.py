@@ -0,0 +1,80 @@
+import threading
+import time
+
+
+class RenderScheduler:
+  """
+  Merges refresh requests from a block into frames, drawing at most `fps` of them per second.
+
+  Requests that arrive between frames are dropped (and counted), but a frame is always
+  drawn shortly after the last request, so the final state is never left undrawn.
+  """
+
+  def __init__(self, render, fps=30):
+    self.render = render
+    self.interval = 1 / fps if fps else 0
+
+    self.last_frame_time = 0
+    self.frames = 0
+    self.dropped_frames = 0
+
+    self.pending = False
+    self.timer = None
+    self.closed = False
+
+    # Requests come from the main thread and from Code Interpreter output threads
+    self.lock = threading.RLock()
+
+  def request(self):
+    """
+    Asks for a frame. It's drawn now if we're due one, otherwise shortly.
+    """
+    with self.lock:
+      if self.closed:
+        return
+
+      wait = self.last_frame_time + self.interval - time.monotonic()
+
+      if wait <= 0:
+        self.draw()
+        return
+
+      # A frame is already waiting to be drawn, so this request is merged into it
+      if self.pending:
+        self.dropped_frames += 1
+      self.pending = True
+
+      if self.timer is None:
+        self.timer = threading.Timer(wait, self.draw_pending)
+        self.timer.daemon = True
+        self.timer.start()
+
+  def draw_pending(self):
+    with self.lock:
+      self.timer = None
+      if self.pending and not self.closed:
+        self.draw()
+
+  def flush(self):
+    """
+    Draws a frame right now, whether or not we're due one.
+    """
+    with self.lock:
+      if self.timer is not None:
+        self.timer.cancel()
+        self.timer = None
+      self.draw()
+
+  def close(self):
+    """
+    Draws the final frame. Later requests are ignored.
+    """
+    with self.lock:
+      self.flush()
+      self.closed = True
+
+  def draw(self):
+    self.pending = False
+    self.last_frame_time = time.monotonic()
+    self.frames += 1
+    self.render()
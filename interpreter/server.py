@@ -0,0 +1,280 @@
+import json
+import re
+import shutil
+import threading
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from .process_pool import ProcessPool
+from .utils import MessageBuffer
+
+
+class ServedSession:
+  """
+  A session (see Interpreter.create_session) and the events it has emitted.
+
+  Events are kept so clients can (re)connect to the event stream at any point.
+  An event's id is its index in `events`.
+  """
+
+  def __init__(self, interpreter):
+    self.interpreter = interpreter
+    self.interpreter.event_callback = self.add_event
+    self.events = []
+    self.responding = False
+    self.closed = False
+    self.condition = threading.Condition()
+
+  def add_event(self, event):
+    with self.condition:
+      self.events.append(event)
+      self.condition.notify_all()
+
+  def send_message(self, message):
+    """
+    Starts responding to `message` in a thread.
+    Returns the id of the response's first event, or None if we're still responding to the last one.
+    """
+    with self.condition:
+      if self.responding or self.closed:
+        return None
+      self.responding = True
+      # Taken before the response starts, so none of its events come before it
+      first_event_id = len(self.events)
+
+    threading.Thread(target=self.respond, args=(message,), daemon=True).start()
+    return first_event_id
+
+  def respond(self, message):
+    error = None
+    try:
+      self.interpreter.chat(message)
+    except Exception as e:
+      error = str(e)
+
+    with self.condition:
+      self.responding = False
+      if error is not None:
+        self.events.append({"type": "error", "message": error})
+      # Lets clients know the response (and any code it ran) is finished
+      self.events.append({"type": "done"})
+      self.condition.notify_all()
+      closed = self.closed
+
+    if closed:
+      # The session was closed while we were responding, so it's ours to clean up
+      self.clean_up()
+
+  def wait_for_events(self, after, timeout):
+    """
+    Returns the events from index `after` on, waiting up to `timeout` seconds for there to be some.
+    """
+    with self.condition:
+      self.condition.wait_for(lambda: len(self.events) > after or self.closed, timeout)
+      return self.events[after:]
+
+  def close(self):
+    """
+    Stops the session's response (at its next chunk or step), and kills the code it's running.
+    Once it's stopped, its processes are ended and its working directory removed (if it made one).
+    """
+    with self.condition:
+      self.closed = True
+      responding = self.responding
+      self.condition.notify_all()
+
+    self.interpreter.cancelled.set()
+    if responding:
+      # The response will stop once the code it's running is killed, then clean up
+      self.kill_processes()
+    else:
+      self.clean_up()
+
+  def kill_processes(self):
+    for code_interpreter in list(self.interpreter.code_interpreters.values()):
+      if code_interpreter.proc and code_interpreter.proc.poll() is None:
+        code_interpreter.kill_process()
+
+  def clean_up(self):
+    self.kill_processes()
+    if self.interpreter.made_working_directory:
+      shutil.rmtree(self.interpreter.working_directory, ignore_errors=True)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+  """
+  POST   /sessions                 creates a session, returns {"id": ...}
+  POST   /sessions/<id>/messages   responds to {"message": ...} in the background
+  GET    /sessions/<id>/messages   returns the session's messages
+  GET    /sessions/<id>/events     streams the session's events as Server-Sent Events
+  DELETE /sessions/<id>            ends the session and its processes
+  """
+
+  # How often (in seconds) an idle event stream sends a comment, so dead connections are noticed
+  keepalive_interval = 15
+
+  def do_POST(self):
+    path = urlparse(self.path).path
+
+    if path == "/sessions":
+      session_id = self.server.create_session()
+      self.send_json(201, {"id": session_id})
+      return
+
+    match = re.fullmatch(r"/sessions/([\w-]+)/messages", path)
+    if match:
+      session = self.get_session(match.group(1))
+      if session is None:
+        return
+
+      body = self.read_json()
+      if not isinstance(body, dict) or not isinstance(body.get("message"), str):
+        self.send_json(400, {"error": 'Expected a JSON body like {"message": "..."}'})
+        return
+
+      first_event_id = session.send_message(body["message"])
+      if first_event_id is None:
+        self.send_json(409, {"error": "This session is still responding to a message"})
+        return
+
+      self.send_json(202, {"first_event_id": first_event_id})
+      return
+
+    self.send_json(404, {"error": "Not found"})
+
+  def do_GET(self):
+    url = urlparse(self.path)
+
+    match = re.fullmatch(r"/sessions/([\w-]+)/(messages|events)", url.path)
+    if not match:
+      self.send_json(404, {"error": "Not found"})
+      return
+
+    session = self.get_session(match.group(1))
+    if session is None:
+      return
+
+    if match.group(2) == "messages":
+      # The last message is still a MessageBuffer while it's streaming in
+      messages = [message.to_dict() if isinstance(message, MessageBuffer) else message
+                  for message in list(session.interpreter.messages)]
+      self.send_json(200, messages)
+      return
+
+    # Start after the last event the client saw, if it's reconnecting, or where it asks to
+    after = 0
+    try:
+      if "Last-Event-ID" in self.headers:
+        after = int(self.headers["Last-Event-ID"]) + 1
+      elif "after" in parse_qs(url.query):
+        after = int(parse_qs(url.query)["after"][0])
+    except ValueError:
+      after = -1
+    if after < 0:
+      self.send_json(400, {"error": "Expected an event id (Last-Event-ID or ?after=) like 0, 1, 2..."})
+      return
+
+    self.send_response(200)
+    self.send_header("Content-Type", "text/event-stream")
+    self.send_header("Cache-Control", "no-cache")
+    self.end_headers()
+
+    try:
+      while not session.closed:
+        events = session.wait_for_events(after, self.keepalive_interval)
+        if not events:
+          self.wfile.write(b": keepalive\n\n")
+        for event in events:
+          self.wfile.write(f"id: {after}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+          after += 1
+        self.wfile.flush()
+    except (BrokenPipeError, ConnectionResetError):
+      # The client went away
+      pass
+
+  def do_DELETE(self):
+    match = re.fullmatch(r"/sessions/([\w-]+)", urlparse(self.path).path)
+    if not match:
+      self.send_json(404, {"error": "Not found"})
+      return
+
+    session = self.server.sessions.pop(match.group(1), None)
+    if session is None:
+      self.send_json(404, {"error": "No session with that id"})
+      return
+
+    session.close()
+    self.send_json(200, {"id": match.group(1)})
+
+  def get_session(self, session_id):
+    session = self.server.sessions.get(session_id)
+    if session is None:
+      self.send_json(404, {"error": "No session with that id"})
+    return session
+
+  def read_json(self):
+    length = int(self.headers.get("Content-Length", 0))
+    try:
+      return json.loads(self.rfile.read(length) or b"null")
+    except ValueError:
+      return None
+
+  def send_json(self, status, body):
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    if self.server.interpreter.debug_mode:
+      super().log_message(format, *args)
+
+
+class InterpreterServer(ThreadingHTTPServer):
+  """
+  Serves sessions of `interpreter` over HTTP (see RequestHandler for the endpoints).
+
+  Sessions, their Code Interpreters' processes and the LLM stay loaded between requests.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, interpreter, host="127.0.0.1", port=8000):
+    super().__init__((host, port), RequestHandler)
+    self.interpreter = interpreter
+    self.sessions = {}
+
+  def create_session(self):
+    session_id = uuid.uuid4().hex
+    self.sessions[session_id] = ServedSession(self.interpreter.create_session(headless=True))
+    return session_id
+
+
+def serve(interpreter, host="127.0.0.1", port=8000):
+  """
+  Loads the LLM, then serves sessions of `interpreter` until interrupted.
+  """
+  # There's no terminal to draw on (or to ask for confirmation from)
+  interpreter.headless = True
+  interpreter.connect()
+
+  # Keep interpreters started for sessions' first runs
+  if interpreter.process_pool is None:
+    interpreter.process_pool = ProcessPool(size=2)
+  for language in ["python", "shell"]:
+    interpreter.process_pool.warm(interpreter.language_map[language]["start_cmd"])
+
+  server = InterpreterServer(interpreter, host, port)
+  print(f"Serving Open Interpreter on http://{host}:{server.server_port}")
+
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    for session in server.sessions.values():
+      session.close()
+    interpreter.process_pool.close()
+    server.server_close()
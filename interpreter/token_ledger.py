@@ -0,0 +1,187 @@
+import tiktoken
+
+
+def tiktoken_tokenizer(model=None):
+  """
+  Returns a function that tokenizes text with tiktoken's encoding for `model` (cl100k_base if it has none).
+  """
+  try:
+    encoding = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding("cl100k_base")
+  except KeyError:
+    encoding = tiktoken.get_encoding("cl100k_base")
+  return encoding.encode
+
+
+def llm_tokenizer(llm):
+  """
+  Returns a function that tokenizes text with `llm`'s own vocabulary (like a llama_cpp Llama's),
+  or None if it can't tokenize.
+  """
+  if not callable(getattr(llm, "tokenize", None)):
+    return None
+  return lambda text: llm.tokenize(text.encode(), add_bos=False)
+
+
+class TokenLedger:
+  """
+  Counts the tokens in messages, remembering each message's count until its content changes.
+
+  The conversation is trimmed to fit the context window before every response, and only its
+  newest message or two have changed since last time, so only those are tokenized again.
+
+  `tokenize` is a function from text to tokens. By default it's tiktoken's (see tiktoken_tokenizer),
+  which only approximates other models' vocabularies.
+  """
+
+  # Like tokentrim's counts for models it doesn't know (how chat templates wrap messages varies)
+  tokens_per_message = 4
+  tokens_per_name = 2
+  tokens_per_conversation = 3
+
+  def __init__(self, tokenize=None):
+    self._tokenize = tokenize
+    # id(message) -> (its values when counted, its count)
+    self.counts = {}
+    # The last system message we were given, so it's counted once too
+    self.system_message = None
+
+  @property
+  def tokenize(self):
+    if self._tokenize is None:
+      # Loaded when it's first needed, since tiktoken might download its encoding
+      self._tokenize = tiktoken_tokenizer()
+    return self._tokenize
+
+  @tokenize.setter
+  def tokenize(self, tokenize):
+    if tokenize is not self._tokenize:
+      # Counts from another tokenizer don't hold
+      self.counts = {}
+    self._tokenize = tokenize
+
+  def count(self, message):
+    """
+    Returns the number of tokens in `message`, tokenizing it only if it's new or has changed.
+    """
+    # Content is usually the same string as last time, so comparing these is cheap
+    values = tuple(message.values())
+    cached = self.counts.get(id(message))
+    if cached is not None and cached[0] == values:
+      return cached[1]
+
+    count = self.tokens_per_message
+    for key, value in message.items():
+      count += len(self.tokenize(str(value)))
+      if key == "name":
+        count += self.tokens_per_name
+
+    self.counts[id(message)] = (values, count)
+    return count
+
+  def system_message_for(self, system_message):
+    """
+    Returns `system_message` as a message, the same one as last time if it hasn't changed (so it's counted once).
+    """
+    if self.system_message is None or self.system_message["content"] != system_message:
+      self.system_message = {"role": "system", "content": system_message}
+    return self.system_message
+
+  def trim(self, messages, max_tokens, system_message=None, pinned=None):
+    """
+    Returns the newest of `messages` that fit in `max_tokens` (with `system_message` first, if given).
+    `pinned`, one of `messages` (like the first user message), is kept even if older messages aren't.
+
+    The newest message comes first, then `pinned`, then the rest, newest first. Either of the first two
+    might have the middle of its content cut out to fit, as might the oldest of the rest that's kept.
+    Messages are never changed: those are copied.
+    """
+    max_tokens -= self.tokens_per_conversation
+
+    trimmed = []
+    if system_message:
+      max_tokens -= self.count(self.system_message_for(system_message))
+
+    # The newest message (like what the user just asked) always gets what it needs
+    newest = self.fit(messages[-1], max_tokens) if messages else None
+    if newest is not None:
+      max_tokens -= self.count(newest)
+
+    # Then the pinned message gets what's left
+    fitted_pinned = None
+    if pinned is not None and messages and pinned is not messages[-1]:
+      fitted_pinned = self.fit(pinned, max_tokens)
+      if fitted_pinned is not None:
+        max_tokens -= self.count(fitted_pinned)
+
+    if newest is not None:
+      trimmed.append(newest)
+
+    # Then the rest, newest first (if the newest fit without being cut, there might be room)
+    older = messages[:-1] if newest is not None and newest is messages[-1] else []
+    for message in reversed(older):
+      if message is pinned:
+        # Its tokens are already counted
+        if fitted_pinned is not None:
+          trimmed.append(fitted_pinned)
+          fitted_pinned = None
+        continue
+
+      fitted = self.fit(message, max_tokens)
+      if fitted is None:
+        break
+      trimmed.append(fitted)
+      max_tokens -= self.count(fitted)
+      if fitted is not message:
+        # It was cut down to fit, so nothing older will
+        break
+
+    if fitted_pinned is not None:
+      trimmed.append(fitted_pinned)
+    if system_message:
+      trimmed.append(self.system_message)
+
+    # Forget messages that are gone (their ids could be reused)
+    kept = {id(message) for message in messages} | {id(self.system_message)}
+    for message_id in list(self.counts):
+      if message_id not in kept:
+        del self.counts[message_id]
+
+    return trimmed[::-1]
+
+  def fit(self, message, max_tokens):
+    """
+    Returns `message` if it fits in `max_tokens`, or else a shortened copy if it can be cut to fit, or else None.
+    """
+    if self.count(message) <= max_tokens:
+      return message
+    # Function calls can't be cut
+    if "function_call" in message or not isinstance(message.get("content"), str):
+      return None
+    return self.shorten(message, max_tokens)
+
+  def shorten(self, message, max_tokens, max_tries=12):
+    """
+    Returns a copy of `message` with the middle of its content cut out until it fits in `max_tokens`,
+    or None if it can't.
+    """
+    shortened = dict(message)
+    content = message["content"]
+
+    # What the message costs besides its content
+    overhead = self.count(dict(message, content=""))
+    if overhead >= max_tokens:
+      return None
+
+    for _ in range(max_tries):
+      tokens = self.count(shortened)
+      if tokens <= max_tokens:
+        return shortened
+
+      # Cut it down by how far over it is, assuming its tokens are about the same length
+      keep = int(len(content) * (max_tokens - overhead) / (tokens - overhead)) // 2
+      if keep <= 0:
+        break
+      content = content[:keep] + "..." + content[-keep:]
+      shortened["content"] = content
+
+    return None
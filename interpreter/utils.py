@@ -1,79 +1,409 @@
 import json
 import re
+from collections.abc import MutableMapping
 
 def merge_deltas(original, delta):
     """
     Pushes the delta into the original and returns that.
 
     Great for reconstructing OpenAI streaming responses -> complete message objects.
+    The original is turned into a MessageBuffer, so string fields are appended
+    to without copying what's already been streamed.
     """
-    for key, value in delta.items():
-        if isinstance(value, dict):
-            if key not in original:
-                original[key] = value
-            else:
-                merge_deltas(original[key], value)
-        else:
-            if key in original:
-                original[key] += value
-            else:
-                original[key] = value
+    if not isinstance(original, MessageBuffer):
+        original = MessageBuffer(original)
+    original.merge(delta)
     return original
 
+
+class Fragments(list):
+    """
+    The streamed pieces of a string field in a MessageBuffer.
+    """
+
+    def text(self):
+        """
+        Returns the pieces joined, and keeps the result so the next read only joins what's new.
+        """
+        if len(self) > 1:
+            self[:] = ["".join(self)]
+        return self[0] if self else ""
+
+
+class MessageBuffer(MutableMapping):
+    """
+    A message that's being streamed in.
+
+    String fields are kept as lists of fragments and only joined when they're read,
+    so long responses don't get copied on every chunk. It behaves like a dict,
+    so everything reading `self.messages` keeps working.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.fields = {}
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        value = self.fields[key]
+        if isinstance(value, Fragments):
+            # Join lazily
+            return value.text()
+        return value
+
+    def __contains__(self, key):
+        # Without this, Mapping's `in` would read (and join) the field
+        return key in self.fields
+
+    def __setitem__(self, key, value):
+        self.fields[key] = value
+
+    def __delitem__(self, key):
+        del self.fields[key]
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def merge(self, delta):
+        """
+        Pushes a streamed delta into this message.
+        """
+        for key, value in delta.items():
+            existing = self.fields.get(key)
+            if isinstance(value, dict):
+                if key not in self.fields:
+                    self.fields[key] = MessageBuffer(value)
+                else:
+                    if not isinstance(existing, MessageBuffer):
+                        existing = self.fields[key] = MessageBuffer(existing)
+                    existing.merge(value)
+            elif isinstance(value, str):
+                if isinstance(existing, Fragments):
+                    existing.append(value)
+                elif isinstance(existing, str):
+                    self.fields[key] = Fragments([existing, value])
+                elif existing is None:
+                    self.fields[key] = Fragments([value])
+                else:
+                    self.fields[key] = existing + value
+            else:
+                if key in self.fields:
+                    self.fields[key] = self[key] + value
+                else:
+                    self.fields[key] = value
+        return self
+
+    def to_dict(self):
+        """
+        Returns this message as a plain dict (for JSON, the API, etc.)
+
+        It only reads the buffer, so it's safe to call while another thread streams into it.
+        """
+        fields = {}
+        for key, value in list(self.fields.items()):
+            if isinstance(value, MessageBuffer):
+                value = value.to_dict()
+            elif isinstance(value, Fragments):
+                value = "".join(value)
+            fields[key] = value
+        return fields
+
 def parse_partial_json(s):
+    """
+    Parses a string of (possibly incomplete) JSON, closing any open strings and structures.
+
+    Returns None if the string can't be parsed.
+    """
+    parser = PartialJSONParser()
+    parser.feed(s)
+    return parser.value()
+
+
+# Characters that follow a backslash in a JSON string, and what they decode to
+json_escapes = {
+    '"': '"',
+    '\\': '\\',
+    '/': '/',
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+}
+
+
+class PartialJSONParser:
+    """
+    Incrementally parses a streamed JSON object (like a function_call's `arguments`).
+
+    `feed` only looks at the new characters, and keeps its string/stack state between calls.
+    Top-level string fields (like `language` and `code`) are decoded as they stream in,
+    and `feed` returns what was decoded into each, so callers can append it instead of
+    reading the whole field again.
+    """
+
+    def __init__(self):
+        # Structural state, used to close the JSON in `value()`
+        self.chunks = []
+        self.stack = []
+        self.is_inside_string = False
+        self.escaped = False
+        self.malformed = False
+
+        # Decoding state for top-level string fields
+        self.fields = {}
+        self.expecting = None
+        self.current_key = None
+        self.string_target = None
+        # Field -> what was decoded into it by the current `feed`
+        self.deltas = {}
+        self.decode_escape = False
+        self.unicode_digits = None
+        self.high_surrogate = None
+
+    @property
+    def language(self):
+        return self.get("language")
+
+    @property
+    def code(self):
+        return self.get("code")
+
+    def get(self, key, default=None):
+        """
+        Returns the decoded value of a top-level string field, even if it's still streaming.
+        """
+        pieces = self.fields.get(key)
+        if pieces is None:
+            return default
+        return pieces.text()
 
-    # Attempt to parse the string as-is.
-    try:
-        return json.loads(s)
-    except json.JSONDecodeError:
-        pass
-  
-    # Initialize variables.
-    new_s = ""
-    stack = []
-    is_inside_string = False
-    escaped = False
-
-    # Process each character in the string one at a time.
-    for char in s:
-        if is_inside_string:
-            if char == '"' and not escaped:
-                is_inside_string = False
-            elif char == '\n' and not escaped:
-                char = '\\n' # Replace the newline character with the escape sequence.
-            elif char == '\\':
-                escaped = not escaped
+    def feed(self, delta):
+        """
+        Processes the next piece of the JSON string.
+
+        Returns the text it decoded into each top-level string field, like {"code": "print("}.
+        """
+        if self.malformed:
+            return {}
+
+        new_s = []
+        self.deltas = {}
+
+        for char in delta:
+            if self.is_inside_string:
+                if char == '"' and not self.escaped:
+                    self.is_inside_string = False
+                    self.end_string()
+                else:
+                    self.decode_string_char(char)
+                    if char == '\n' and not self.escaped:
+                        char = '\\n' # Replace the newline character with the escape sequence.
+                    elif char == '\\':
+                        self.escaped = not self.escaped
+                    else:
+                        self.escaped = False
+            else:
+                if char == '"':
+                    self.is_inside_string = True
+                    self.escaped = False
+                    self.start_string()
+                elif char == '{' or char == '[':
+                    self.stack.append('}' if char == '{' else ']')
+                    if char == '{' and len(self.stack) == 1:
+                        self.expecting = "key"
+                elif char == '}' or char == ']':
+                    if self.stack and self.stack[-1] == char:
+                        self.stack.pop()
+                    else:
+                        # Mismatched closing character; the input is malformed.
+                        self.malformed = True
+                        return {}
+                elif len(self.stack) == 1:
+                    if char == ':':
+                        self.expecting = "value"
+                    elif char == ',':
+                        self.expecting = "key"
+
+            new_s.append(char)
+
+        self.chunks.append("".join(new_s))
+        return {key: "".join(pieces) for key, pieces in self.deltas.items()}
+
+    def start_string(self):
+        self.string_target = None
+        self.decode_escape = False
+        self.unicode_digits = None
+        self.high_surrogate = None
+
+        # We only decode strings that are keys or values of the top-level object
+        if len(self.stack) != 1 or self.stack[-1] != '}':
+            return
+        if self.expecting == "key":
+            self.string_target = []
+        elif self.expecting == "value" and self.current_key is not None:
+            self.string_target = self.fields[self.current_key] = Fragments()
+            self.deltas[self.current_key] = []
+
+    def decoded(self, text):
+        self.string_target.append(text)
+        if self.expecting == "value":
+            self.deltas.setdefault(self.current_key, []).append(text)
+
+    def end_string(self):
+        if len(self.stack) == 1 and self.expecting == "key" and self.string_target is not None:
+            self.current_key = "".join(self.string_target)
+        self.string_target = None
+
+    def decode_string_char(self, char):
+        if self.string_target is None:
+            return
+
+        if self.unicode_digits is not None:
+            self.unicode_digits += char
+            if len(self.unicode_digits) < 4:
+                return
+            try:
+                code_point = int(self.unicode_digits, 16)
+            except ValueError:
+                code_point = None
+            self.unicode_digits = None
+            if code_point is None:
+                return
+
+            # Surrogate pairs arrive as two escapes, so we hold on to the first half
+            if 0xD800 <= code_point <= 0xDBFF:
+                self.high_surrogate = code_point
+                return
+            if 0xDC00 <= code_point <= 0xDFFF and self.high_surrogate is not None:
+                code_point = 0x10000 + ((self.high_surrogate - 0xD800) << 10) + (code_point - 0xDC00)
+            self.high_surrogate = None
+            self.decoded(chr(code_point))
+
+        elif self.decode_escape:
+            self.decode_escape = False
+            if char == 'u':
+                self.unicode_digits = ""
             else:
-                escaped = False
+                self.decoded(json_escapes.get(char, char))
+
+        elif char == '\\':
+            self.decode_escape = True
+
         else:
-            if char == '"':
-                is_inside_string = True
-                escaped = False
-            elif char == '{':
-                stack.append('}')
-            elif char == '[':
-                stack.append(']')
-            elif char == '}' or char == ']':
-                if stack and stack[-1] == char:
-                    stack.pop()
+            self.decoded(char)
+
+    def value(self):
+        """
+        Closes any open strings and structures, then parses what we have so far.
+
+        Returns None if it can't be parsed.
+        """
+        if self.malformed:
+            return None
+
+        if len(self.chunks) > 1:
+            self.chunks[:] = ["".join(self.chunks)]
+        new_s = self.chunks[0] if self.chunks else ""
+
+        # If we're still inside a string, we need to close the string.
+        if self.is_inside_string:
+            new_s += '"'
+
+        # Close any remaining open structures in the reverse order that they were opened.
+        new_s += "".join(reversed(self.stack))
+
+        # Attempt to parse the modified string as JSON.
+        try:
+            return json.loads(new_s)
+        except json.JSONDecodeError:
+            # If we still can't parse the string as JSON, return None to indicate failure.
+            return None
+
+
+class CodeFenceTracker:
+    """
+    Tracks fenced code blocks (```) in a streamed markdown message.
+
+    Each token is only looked at once. `feed` returns a list of (event, data) tuples:
+
+      ("enter", None)     We just entered a code block
+      ("language", lang)  The code block's language line is complete
+      ("code", delta)     New code was written in the open code block
+      ("close", None)     We just closed the code block
+    """
+
+    def __init__(self):
+        self.in_code_block = False
+        self.language = None
+
+        # Backticks we've seen but can't yet tell apart from a fence
+        self.backticks = 0
+
+        self.language_line = []
+        self.code_pieces = Fragments()
+
+    @property
+    def code(self):
+        """
+        The code in the current (or last) code block.
+        """
+        return self.code_pieces.text().strip("` \n")
+
+    def feed(self, text):
+        events = []
+        code_delta = []
+
+        for char in text:
+            if char == '`':
+                self.backticks += 1
+                if self.backticks < 3:
+                    continue
+                self.backticks = 0
+
+                if self.in_code_block:
+                    if code_delta:
+                        events.append(("code", "".join(code_delta)))
+                        code_delta = []
+                    if self.language is None:
+                        # It closed on its first line (like ```python```), so that's its language
+                        self.language = "".join(self.language_line).strip() or "python"
+                        events.append(("language", self.language))
+                    self.in_code_block = False
+                    events.append(("close", None))
+                else:
+                    self.in_code_block = True
+                    self.language = None
+                    self.language_line = []
+                    self.code_pieces = Fragments()
+                    events.append(("enter", None))
+                continue
+
+            if not self.in_code_block:
+                self.backticks = 0
+                continue
+
+            # These backticks turned out not to be a fence, so they're part of the block
+            pending = '`' * self.backticks + char
+            self.backticks = 0
+
+            if self.language is None:
+                if char == '\n':
+                    self.language_line.append(pending[:-1])
+                    self.language = "".join(self.language_line).strip() or "python"
+                    events.append(("language", self.language))
                 else:
-                    # Mismatched closing character; the input is malformed.
-                    return None
-        
-        # Append the processed character to the new string.
-        new_s += char
-
-    # If we're still inside a string at the end of processing, we need to close the string.
-    if is_inside_string:
-        new_s += '"'
-
-    # Close any remaining open structures in the reverse order that they were opened.
-    for closing_char in reversed(stack):
-        new_s += closing_char
-
-    # Attempt to parse the modified string as JSON.
-    try:
-        return json.loads(new_s)
-    except json.JSONDecodeError:
-        # If we still can't parse the string as JSON, return None to indicate failure.
-        return None
+                    self.language_line.append(pending)
+            else:
+                code_delta.append(pending)
+                self.code_pieces.append(pending)
+
+        if code_delta:
+            events.append(("code", "".join(code_delta)))
+
+        return events
@@ -0,0 +1,142 @@
+import asyncio
+import copy
+import sys
+import pytest
+from interpreter.code_interpreter import CodeInterpreter, OutputBuffer, language_map
+from interpreter.process_pool import ProcessPool
+from interpreter.headless_block import HeadlessCodeBlock
+
+
+def run_async(language, code):
+    code_interpreter = CodeInterpreter(language, False)
+    code_interpreter.active_block = HeadlessCodeBlock(lambda event: None)
+    code_interpreter.active_block.code = code
+    return asyncio.run(code_interpreter.arun())
+
+def test_arun():
+    assert run_async("python", "for i in range(3):\n    print(i)") == "0\n1\n2"
+    assert run_async("shell", "echo hello") == "hello"
+
+def test_working_directory(tmp_path):
+    code_interpreter = CodeInterpreter("python", False, working_directory=str(tmp_path))
+    code_interpreter.active_block = HeadlessCodeBlock(lambda event: None)
+    code_interpreter.active_block.code = "import os\nprint(os.getcwd())"
+    assert code_interpreter.run() == str(tmp_path)
+    code_interpreter.proc.kill()
+
+def test_process_pool(tmp_path):
+    process_pool = ProcessPool(size=1)
+    start_cmd = language_map["python"]["start_cmd"]
+    process_pool.fill(start_cmd)
+    process = process_pool.ready[start_cmd][0]
+
+    code_interpreter = CodeInterpreter("python", False, working_directory=str(tmp_path), process_pool=process_pool)
+    code_interpreter.active_block = HeadlessCodeBlock(lambda event: None)
+    code_interpreter.active_block.code = "import os\nprint(os.getcwd())"
+    assert code_interpreter.run() == str(tmp_path)
+    assert code_interpreter.proc is process
+
+    code_interpreter.proc.kill()
+    process_pool.close()
+
+def test_control_messages_dont_mix_with_output():
+    code_interpreter = CodeInterpreter("python", False)
+    code_interpreter.active_block = HeadlessCodeBlock(lambda event: None)
+    code_interpreter.active_block.code = 'print("ACTIVE_LINE:5")\nprint("END_OF_EXECUTION")\nprint("done")'
+    assert code_interpreter.run() == "ACTIVE_LINE:5\nEND_OF_EXECUTION\ndone"
+    code_interpreter.proc.kill()
+
+def test_python_kernel():
+    code_interpreter = CodeInterpreter("python", False)
+    code_interpreter.active_block = HeadlessCodeBlock(lambda event: None)
+    for code, output in [("x = 1\n\nif x:\n\n    exit()", ""),
+                         ("print(x, end='')", "1"),
+                         ("1/0", "ZeroDivisionError: division by zero"),
+                         ("input()", "EOFError: EOF when reading a line")]:
+        code_interpreter.active_block.code = code
+        assert code_interpreter.run().endswith(output)
+    code_interpreter.proc.kill()
+
+def test_python_kernel_streams_act_like_real_ones(tmp_path):
+    (tmp_path / "utils.py").write_text("where = 'working directory'")
+    code_interpreter = CodeInterpreter("python", False, working_directory=str(tmp_path))
+    code_interpreter.active_block = HeadlessCodeBlock(lambda event: None)
+    for code, output in [("import sys\nprint(sys.stdout.encoding, sys.argv)", "utf-8 ['']"),
+                         ("import subprocess\nprint('a')\nsubprocess.run(['echo', 'b'], stdout=sys.stdout)", "a\nb"),
+                         ("import faulthandler\nfaulthandler.enable()\nsys.stdout.buffer.write('é\\n'.encode())", "é"),
+                         ("import utils\nprint(utils.where)", "working directory"),
+                         ("import pickle\ndef f(): pass\nprint(pickle.loads(pickle.dumps(f)) is f)", "True")]:
+        code_interpreter.active_block.code = code
+        assert code_interpreter.run() == output
+    code_interpreter.proc.kill()
+
+def test_active_line_sampling():
+    events = []
+    code_interpreter = CodeInterpreter("python", False, events.append)
+    code_interpreter.active_block = HeadlessCodeBlock(lambda event: None)
+    code_interpreter.active_block.code = "import time\nfor i in range(100000):\n    pass\ntime.sleep(0.2)\n1/0"
+    assert 'line 5' in code_interpreter.run()
+    active_lines = [event["line"] for event in events if event["type"] == "active_line"]
+    assert 4 in active_lines and len(active_lines) < 10
+    code_interpreter.proc.kill()
+
+def test_output_buffer():
+    output_buffer = OutputBuffer(head_chars=10, tail_chars=10)
+    for i in range(100):
+        output_buffer.append(f"line {i}")
+    assert str(output_buffer) == "line 0\n\nOutput truncated. 98 lines (775 bytes) were left out here.\n\nline 99"
+    assert output_buffer.dropped_lines == 98
+
+    # A line too long for the head still starts it off
+    output_buffer = OutputBuffer(head_chars=10, tail_chars=10)
+    output_buffer.append("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWX")
+    assert str(output_buffer) == "abcdefghi\n\nOutput truncated. 31 bytes were left out here.\n\nOPQRSTUVWX"
+
+def test_long_line_without_newlines():
+    code_interpreter = CodeInterpreter("shell", False)
+    code_interpreter.active_block = HeadlessCodeBlock(lambda event: None)
+    code_interpreter.active_block.code = "head -c 4000000 /dev/zero | tr '\\0' x; echo; echo end"
+    output = code_interpreter.run()
+    assert output.startswith("x" * 900) and output.endswith("end")
+    assert "bytes) were left out here" in output
+    # What's held of a line that hasn't ended stays bounded
+    assert max(code_interpreter.partial_lengths.values()) == 0
+    code_interpreter.proc.kill()
+
+def test_carriage_returns_and_invalid_utf8():
+    assert run_async("shell", "printf 'a\\rb\\377\\n'") == "a\nb�"
+    assert run_async("python", "import sys\nsys.stdout.write('x\\r\\ny\\r')") == "x\ny"
+
+def test_wall_time_limit():
+    languages = copy.deepcopy(language_map)
+    languages["shell"]["limits"]["wall_time"] = 0.5
+    code_interpreter = CodeInterpreter("shell", False, languages=languages)
+    code_interpreter.active_block = HeadlessCodeBlock(lambda event: None)
+    code_interpreter.active_block.code = "echo started; sleep 10"
+    assert code_interpreter.run().startswith("started\nLimitExceeded: this code went over its wall_time limit")
+    assert code_interpreter.limit_exceeded == {"limit": "wall_time", "value": 0.5}
+    assert code_interpreter.proc is None
+
+    # The next run gets a new process
+    code_interpreter.active_block.code = "echo again"
+    assert code_interpreter.run() == "again"
+    assert code_interpreter.limit_exceeded is None
+    code_interpreter.proc.kill()
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="rlimits are only set on Linux")
+def test_memory_limit():
+    languages = copy.deepcopy(language_map)
+    languages["python"]["limits"]["memory"] = 512 * 1024**2
+    code_interpreter = CodeInterpreter("python", False, languages=languages)
+    code_interpreter.active_block = HeadlessCodeBlock(lambda event: None)
+    code_interpreter.active_block.code = "x = 1\ny = bytearray(2 * 1024**3)"
+    output = code_interpreter.run()
+    assert "MemoryError" in output
+    assert output.endswith("LimitExceeded: this code ran into its memory limit (536870912), so it failed.")
+    assert code_interpreter.limit_exceeded == {"limit": "memory", "value": 512 * 1024**2}
+
+    # The process wasn't stopped, so earlier variables are still there
+    code_interpreter.active_block.code = "print(x)"
+    assert code_interpreter.run() == "1"
+    assert code_interpreter.limit_exceeded is None
+    code_interpreter.proc.kill()
@@ -0,0 +1,31 @@
+from interpreter.compaction import Compactor, summarize_message
+from interpreter.token_ledger import TokenLedger
+
+
+def test_summarize_message():
+    lines = [f"line {i}" for i in range(50)]
+    lines[20] = "ValueError: bad value"
+    assert summarize_message({"role": "function", "content": "\n".join(lines)}) == \
+        "[Output summarized, from 50 lines]\nline 0\nline 1\n...\nValueError: bad value\n...\nline 48\nline 49"
+    assert summarize_message({"role": "function", "content": "short"}) is None
+
+    message = {"role": "assistant", "content": "Let me check. Then we'll plot it.\n```python\nimport os\nprint(os.listdir())\n```"}
+    assert summarize_message(message) == "Let me check.\n[Ran 2 lines of python, starting: import os]"
+
+def test_compaction_keeps_the_task():
+    ledger = TokenLedger(str.split)
+    compactor = Compactor(ledger)
+    task = {"role": "user", "content": "Plot the revenue in data.csv"}
+    messages = [task]
+    for turn in range(20):
+        messages.append({"role": "assistant", "content": f"Let me look at part {turn}.\n```python\nprint(part({turn}))\n```"})
+        messages.append({"role": "function", "name": "run_code", "content": "\n".join(f"row {i} {turn}" for i in range(20))})
+        compacted = compactor.compact(messages, 1000, "You run code.")
+
+        assert compacted[0] is task
+        assert compacted[-2:] == messages[-2:]
+        assert sum(ledger.count(message) for message in compacted) <= 750
+
+    # Summaries are made once, and reused
+    assert compactor.compact(messages, 1000, "You run code.")[1] is compacted[1]
+    assert messages[1]["content"].startswith("Let me look at part 0.\n```python")
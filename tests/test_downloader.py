@@ -0,0 +1,120 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from interpreter.downloader import download, DownloadError
+
+data = os.urandom(300_000)
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves `data` at /model.gguf (with ranges), redirected to from /resolve/model.gguf like Hugging Face does.
+    """
+
+    sha256 = hashlib.sha256(data).hexdigest()
+    served = []
+    # How many responses to send the headers of, then stall
+    stalls = 0
+
+    def do_HEAD(self):
+        self.respond(include_body=False)
+
+    def do_GET(self):
+        self.respond(include_body=True)
+
+    def respond(self, include_body):
+        if self.path == "/resolve/model.gguf":
+            self.send_response(302)
+            self.send_header("Location", "/model.gguf")
+            self.send_header("X-Linked-Etag", f'"{self.sha256}"')
+            self.end_headers()
+            return
+
+        start, end = 0, len(data) - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+        self.send_response(206 if match else 200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if include_body and RangeRequestHandler.stalls:
+            RangeRequestHandler.stalls -= 1
+            time.sleep(30)
+            return
+        if include_body:
+            self.served.append(end - start + 1)
+            self.wfile.write(data[start:end + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/resolve/model.gguf"
+
+def test_download(tmp_path):
+    server, url = serve()
+    RangeRequestHandler.served = []
+    progress = []
+    path = str(tmp_path / "model.gguf")
+
+    assert download(url, path, piece_size=64_000, progress=lambda done, total: progress.append((done, total))) == path
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert sorted(RangeRequestHandler.served) == [44_000] + [64_000] * 4
+    assert progress[-1] == (len(data), len(data))
+    assert os.listdir(tmp_path) == ["model.gguf"]
+    server.shutdown()
+
+def test_resume(tmp_path):
+    server, url = serve()
+    RangeRequestHandler.served = []
+    path = str(tmp_path / "model.gguf")
+
+    def interrupt(done, total):
+        if done >= 128_000:
+            raise KeyboardInterrupt
+    try:
+        download(url, path, piece_size=64_000, connections=1, progress=interrupt)
+        assert False
+    except KeyboardInterrupt:
+        pass
+    assert os.path.exists(path + ".part.state")
+
+    # Only the pieces that weren't done are fetched
+    RangeRequestHandler.served = []
+    download(url, path, piece_size=64_000, connections=1)
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert sum(RangeRequestHandler.served) < len(data)
+    server.shutdown()
+
+def test_checksum_mismatch(tmp_path):
+    server, url = serve()
+    path = str(tmp_path / "model.gguf")
+    try:
+        download(url, path, sha256="0" * 64)
+        assert False
+    except DownloadError:
+        pass
+    assert os.listdir(tmp_path) == []
+    server.shutdown()
+
+def test_stalled_connection_is_retried(tmp_path):
+    server, url = serve()
+    RangeRequestHandler.stalls = 1
+    path = str(tmp_path / "model.gguf")
+
+    started = time.time()
+    download(url, path, piece_size=64_000, connections=1, timeout=0.5)
+    assert time.time() - started < 10
+    with open(path, "rb") as f:
+        assert f.read() == data
+    assert RangeRequestHandler.stalls == 0
+    server.shutdown()
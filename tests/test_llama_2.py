@@ -0,0 +1,58 @@
+from interpreter.llama_2 import PrefixCachingLlama, choose_context_window, kv_cache_bytes_per_token
+
+
+class CharacterLlama:
+    """
+    Stands in for a llama_cpp Llama whose tokens are characters, and which responds with `response`.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.n_tokens = 0
+        self.evaluated = 0
+
+    def tokenize(self, text, add_bos=True):
+        return ([1] if add_bos else []) + list(text)
+
+    def detokenize(self, tokens):
+        return bytes(tokens)
+
+    def token_eos(self):
+        return 2
+
+    def n_ctx(self):
+        return 4096
+
+    def generate(self, tokens, reset=True, **kwargs):
+        assert not reset
+        response = iter(list(self.response.encode()) + [self.token_eos()])
+        while True:
+            self.n_tokens += len(tokens)
+            self.evaluated += len(tokens)
+            token = next(response)
+            yield token
+            tokens = [token]
+
+
+def test_prefix_caching():
+    llama = CharacterLlama("Hi!")
+    llm = PrefixCachingLlama(llama)
+    assert "".join(chunk["choices"][0]["text"] for chunk in llm("[INST] hello [/INST]")) == "Hi!"
+    assert llama.evaluated == len("[INST] hello [/INST]") + 1 + len("Hi!")
+
+    # Only what's new since the last prompt and its response is evaluated (then the new response)
+    llama.evaluated = 0
+    assert "".join(chunk["choices"][0]["text"] for chunk in llm("[INST] hello [/INST]Hi! [INST] bye [/INST]")) == "Hi!"
+    assert llama.evaluated == len(" [INST] bye [/INST]") + len("Hi!")
+
+def test_stop_sequences():
+    llm = PrefixCachingLlama(CharacterLlama("a</b></s>c"))
+    chunks = list(llm("prompt"))
+    assert "".join(chunk["choices"][0]["text"] for chunk in chunks) == "a</b>"
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+
+def test_choose_context_window():
+    gib = 1024**3
+    assert choose_context_window(4 * gib, kv_cache_bytes_per_token["7B"], memory=8 * gib) == 5376
+    assert choose_context_window(4 * gib, kv_cache_bytes_per_token["7B"], memory=64 * gib) == 16384
+    assert choose_context_window(4 * gib, kv_cache_bytes_per_token["7B"], memory=4 * gib) == 512
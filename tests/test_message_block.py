@@ -0,0 +1,55 @@
+import io
+from rich.console import Console
+from rich.markdown import Markdown
+from interpreter.message_block import MessageBlock, textify_code_blocks
+
+message = """Here's the plan:
+
+```c++
+int main() {
+
+# not a heading
+}
+```
+
+1. First item
+
+   still the first item
+2. Second item
+
+~~~js title=x
+let a = 1;
+
+```
+still code
+~~~
+
+See [the docs][docs] for more.
+
+Done.
+
+[docs]: https://example.com
+"""
+
+
+def render(markdown):
+    console = Console(file=io.StringIO(), width=60, color_system=None)
+    console.print(markdown)
+    return console.file.getvalue()
+
+
+def test_incremental_render_matches_full_render():
+    block = MessageBlock()
+    frozen = False
+    try:
+        for i in range(0, len(message), 7):
+            block.content_pieces.append(message[i:i + 7])
+            content = block.content
+            full = Markdown((content + "█").strip())
+            textify_code_blocks(full.parsed)
+            assert render(block.markdown()) == render(full), content
+            frozen = frozen or block.frozen_content != ""
+        # Blocks were frozen, until the link's definition meant parsing it all together
+        assert frozen and block.frozen_content == ""
+    finally:
+        block.end()
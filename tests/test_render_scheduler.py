@@ -0,0 +1,21 @@
+import time
+from interpreter.render_scheduler import RenderScheduler
+
+
+def test_render_scheduler_merges_frames():
+    drawn = []
+    state = {"value": 0}
+    scheduler = RenderScheduler(lambda: drawn.append(state["value"]), fps=20)
+
+    for i in range(1, 101):
+        state["value"] = i
+        scheduler.request()
+
+    # The first request is drawn right away, the rest are merged into one trailing frame
+    time.sleep(0.2)
+    assert drawn == [1, 100]
+    assert scheduler.dropped_frames == 98
+
+    scheduler.close()
+    scheduler.request()
+    assert drawn == [1, 100, 100]
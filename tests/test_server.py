@@ -0,0 +1,128 @@
+import json
+import threading
+import urllib.request
+from urllib.error import HTTPError
+from interpreter.interpreter import Interpreter
+from interpreter.server import InterpreterServer
+
+
+def request(server, method, path, body=None):
+    url = f"http://127.0.0.1:{server.server_port}{path}"
+    data = json.dumps(body).encode() if body is not None else None
+    return urllib.request.urlopen(urllib.request.Request(url, data=data, method=method))
+
+def test_server():
+    server = InterpreterServer(Interpreter(), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        session_id = json.load(request(server, "POST", "/sessions"))["id"]
+        session = server.sessions[session_id]
+        assert session.interpreter.headless
+
+        session.add_event({"type": "message_delta", "content": "Hi"})
+        session.add_event({"type": "done"})
+
+        stream = request(server, "GET", f"/sessions/{session_id}/events?after=1")
+        assert stream.headers["Content-Type"] == "text/event-stream"
+        assert stream.readline() == b"id: 1\n"
+        assert stream.readline() == b"event: done\n"
+        assert json.loads(stream.readline()[len(b"data: "):]) == {"type": "done"}
+        stream.close()
+
+        for path in [f"/sessions/{session_id}/events?after=x", f"/sessions/{session_id}/events?after=-2"]:
+            try:
+                request(server, "GET", path)
+                assert False
+            except HTTPError as error:
+                assert error.code == 400
+
+        try:
+            request(server, "POST", f"/sessions/{session_id}/messages", {"text": "Hi"})
+            assert False
+        except HTTPError as error:
+            assert error.code == 400
+
+        request(server, "DELETE", f"/sessions/{session_id}")
+        try:
+            request(server, "GET", f"/sessions/{session_id}/messages")
+            assert False
+        except HTTPError as error:
+            assert error.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_messages_while_responding():
+    streamed = threading.Event()
+    finish = threading.Event()
+
+    def llama_instance(prompt, *args, **kwargs):
+        yield {"choices": [{"text": "hello", "finish_reason": None}]}
+        yield {"choices": [{"text": " there", "finish_reason": None}]}
+        streamed.set()
+        finish.wait(5)
+        yield {"choices": [{"text": "", "finish_reason": "stop"}]}
+
+    interpreter = Interpreter()
+    interpreter.local = True
+    interpreter.tokenize = str.split
+    interpreter.llama_instance = llama_instance
+    server = InterpreterServer(interpreter, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        session_id = json.load(request(server, "POST", "/sessions"))["id"]
+        response = json.load(request(server, "POST", f"/sessions/{session_id}/messages", {"message": "Hi"}))
+        assert response == {"first_event_id": 0}
+        assert streamed.wait(5)
+
+        messages = json.load(request(server, "GET", f"/sessions/{session_id}/messages"))
+        assert messages[-1] == {"role": "assistant", "content": "Hello there"}
+    finally:
+        finish.set()
+        server.shutdown()
+        server.server_close()
+
+
+def test_deleting_a_session_stops_it():
+    import os
+    import time
+    turns = []
+
+    def llama_instance(prompt, *args, **kwargs):
+        turns.append(prompt)
+        for token in ["```python\n", "import time\n", "time.sleep(30)\n", "```\n"]:
+            yield {"choices": [{"text": token, "finish_reason": None}]}
+
+    interpreter = Interpreter()
+    interpreter.local = True
+    interpreter.auto_run = True
+    interpreter.tokenize = str.split
+    interpreter.llama_instance = llama_instance
+    server = InterpreterServer(interpreter, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        session_id = json.load(request(server, "POST", "/sessions"))["id"]
+        session = server.sessions[session_id]
+        request(server, "POST", f"/sessions/{session_id}/messages", {"message": "Hi"})
+
+        deadline = time.time() + 10
+        while not session.interpreter.code_interpreters and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.5)
+        request(server, "DELETE", f"/sessions/{session_id}")
+
+        deadline = time.time() + 10
+        while session.responding and time.time() < deadline:
+            time.sleep(0.05)
+        assert not session.responding
+        assert len(turns) == 1
+        assert all(code_interpreter.proc is None or code_interpreter.proc.poll() is not None
+                   for code_interpreter in session.interpreter.code_interpreters.values())
+        assert not os.path.exists(session.interpreter.working_directory)
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,101 @@
+import os
+from interpreter.interpreter import Interpreter
+
+
+def test_create_session():
+    parent = Interpreter()
+    parent.auto_run = True
+    first = parent.create_session(headless=True)
+    second = parent.create_session(headless=True)
+
+    assert first.auto_run and first.headless
+    assert os.path.isdir(first.working_directory)
+    assert first.working_directory != second.working_directory
+    assert first.llama_lock is second.llama_lock
+
+    first.language_map["python"]["start_cmd"] += " -B"
+    assert second.language_map["python"]["start_cmd"] != first.language_map["python"]["start_cmd"]
+
+    first.messages.append({"role": "user", "content": "Hi"})
+    assert second.messages == []
+
+
+def test_more_async_sessions_than_executor_threads():
+    import asyncio
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    def llama_instance(prompt, *args, **kwargs):
+        for token in ["All", " done", "."]:
+            time.sleep(0.01)
+            yield {"choices": [{"text": token, "finish_reason": None}]}
+        yield {"choices": [{"text": "", "finish_reason": "stop"}]}
+
+    parent = Interpreter()
+    parent.local = True
+    parent.headless = True
+    parent.tokenize = str.split
+    parent.llama_instance = llama_instance
+
+    sessions = [parent.create_session() for _ in range(8)]
+    for session in sessions:
+        session.messages.append({"role": "user", "content": "Hi"})
+
+    async def main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(2))
+        await asyncio.wait_for(asyncio.gather(*[session.arespond() for session in sessions]), 10)
+
+    asyncio.run(main())
+    assert all(session.messages[-1]["content"] == "All done." for session in sessions)
+
+
+def test_abandoned_stream_chat_stops_responding():
+    import time
+
+    def llama_instance(prompt, *args, **kwargs):
+        for _ in range(1000):
+            time.sleep(0.01)
+            yield {"choices": [{"text": "word ", "finish_reason": None}]}
+        yield {"choices": [{"text": "", "finish_reason": "stop"}]}
+
+    interpreter = Interpreter()
+    interpreter.local = True
+    interpreter.tokenize = str.split
+    interpreter.llama_instance = llama_instance
+    interpreter.connect = lambda: None
+
+    stream = interpreter.chat("Hi", stream=True)
+    assert next(stream)["type"] == "message_delta"
+    stream.close()
+
+    # The response stops at its next chunk, and puts back how we were displaying
+    deadline = time.time() + 5
+    while interpreter.headless and time.time() < deadline:
+        time.sleep(0.01)
+    assert not interpreter.headless and interpreter.event_callback is None
+    assert len(interpreter.messages[-1]["content"].split()) < 100
+
+
+def test_streaming_again_after_abandoning_a_stream():
+    import time
+
+    def llama_instance(prompt, *args, **kwargs):
+        for _ in range(20):
+            time.sleep(0.01)
+            yield {"choices": [{"text": "word ", "finish_reason": None}]}
+        yield {"choices": [{"text": "", "finish_reason": "stop"}]}
+
+    interpreter = Interpreter()
+    interpreter.local = True
+    interpreter.tokenize = str.split
+    interpreter.llama_instance = llama_instance
+    interpreter.connect = lambda: None
+
+    first = interpreter.chat("Hi", stream=True)
+    next(first)
+    first.close()
+
+    # The second stream gets all of its response, even though the first one's was still stopping
+    second = list(interpreter.chat("Hi again", stream=True))
+    assert "".join(event["content"] for event in second) == "Word " + "word " * 19
+    assert not interpreter.headless and interpreter.event_callback is None
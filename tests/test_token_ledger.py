@@ -0,0 +1,42 @@
+from interpreter.token_ledger import TokenLedger
+
+
+def test_only_changed_messages_are_tokenized():
+    tokenized = []
+    def tokenize(text):
+        tokenized.append(text)
+        return text.split()
+
+    ledger = TokenLedger(tokenize)
+    messages = [{"role": "user", "content": "one two three"}, {"role": "assistant", "content": "four"}]
+    ledger.trim(messages, 100, "be nice")
+    tokenized.clear()
+
+    messages[-1]["content"] += " five"
+    messages.append({"role": "user", "content": "six"})
+    assert ledger.trim(messages, 100, "be nice")[1:] == messages
+    assert tokenized == ["user", "six", "assistant", "four five"]
+
+def test_trim():
+    ledger = TokenLedger(str.split)
+    messages = [{"role": "user", "content": " ".join(str(i) for i in range(100))},
+                {"role": "assistant", "content": "a b c"},
+                {"role": "user", "content": "d e"}]
+    trimmed = ledger.trim(messages, 40, "system")
+    assert [message["role"] for message in trimmed] == ["system", "user", "assistant", "user"]
+    assert trimmed[1]["content"].startswith("0 1 2") and trimmed[1]["content"].endswith("98 99")
+    assert sum(ledger.count(message) for message in trimmed) + 3 <= 40
+    # The message that was cut down was copied
+    assert messages[0]["content"].count(" ") == 99
+
+def test_trim_shortens_a_pinned_task_before_dropping_the_newest_message():
+    ledger = TokenLedger(str.split)
+    task = {"role": "user", "content": " ".join(str(i) for i in range(500))}
+    messages = [task,
+                {"role": "assistant", "content": "Working on it."},
+                {"role": "user", "content": "What's next?"}]
+    trimmed = ledger.trim(messages, 100, "system", pinned=task)
+    assert [message["role"] for message in trimmed] == ["system", "user", "user"]
+    assert trimmed[-1] is messages[-1]
+    assert trimmed[1]["content"].startswith("0 1 2") and trimmed[1]["content"].endswith("498 499")
+    assert sum(ledger.count(message) for message in trimmed) + 3 <= 100
@@ -0,0 +1,85 @@
+import json
+from interpreter.utils import merge_deltas, parse_partial_json, PartialJSONParser, CodeFenceTracker
+
+
+def test_parse_partial_json():
+    assert parse_partial_json('{"language": "python", "code": "print(1)\nprint(') == {"language": "python", "code": "print(1)\nprint("}
+    assert parse_partial_json('{"a": [1, {"b": "c') == {"a": [1, {"b": "c"}]}
+    assert parse_partial_json('{"a": ]') is None
+
+def test_partial_json_parser_streams_fields():
+    arguments = json.dumps({"language": "python", "code": "for i in range(3):\n    print(\"\\u00e9\", i) # 😀"}, ensure_ascii=True)
+    parser = PartialJSONParser()
+    fed = {}
+    for i in range(0, len(arguments), 3):
+        for key, delta in parser.feed(arguments[i:i+3]).items():
+            fed[key] = fed.get(key, "") + delta
+    assert fed == json.loads(arguments)
+    assert parser.language == "python"
+    assert parser.code == json.loads(arguments)["code"]
+    assert parser.value() == json.loads(arguments)
+
+def test_code_fence_tracker():
+    tracker = CodeFenceTracker()
+    events = []
+    for token in ["Here you go:\n``", "`pyth", "on\nprint('a", " `b`')\n`", "``\nDone."]:
+        events += tracker.feed(token)
+    assert [event for event, _ in events] == ["enter", "language", "code", "code", "close"]
+    assert not tracker.in_code_block
+    assert tracker.language == "python"
+    assert tracker.code == "print('a `b`')"
+
+def test_code_fence_closed_on_its_first_line():
+    tracker = CodeFenceTracker()
+    events = []
+    for token in ["```", "python", "```"]:
+        events += tracker.feed(token)
+    assert events == [("enter", None), ("language", "python"), ("close", None)]
+
+    from interpreter.interpreter import Interpreter
+    interpreter = Interpreter()
+    interpreter.local = True
+    interpreter.headless = True
+    interpreter.auto_run = True
+    interpreter.tokenize = str.split
+    turns = [["```", "python", "```"], ["Done."]]
+
+    def llama_instance(prompt, *args, **kwargs):
+        for token in turns.pop(0):
+            yield {"choices": [{"text": token, "finish_reason": None}]}
+        yield {"choices": [{"text": "", "finish_reason": "stop"}]}
+
+    interpreter.llama_instance = llama_instance
+    interpreter.messages.append({"role": "user", "content": "Hi"})
+    interpreter.respond()
+    assert interpreter.messages[1]["function_call"]["parsed_arguments"] == {"code": "", "language": "python"}
+    assert interpreter.messages[-1]["content"] == "Done."
+
+def test_merge_deltas():
+    message = {}
+    for delta in [{"role": "assistant", "content": None, "function_call": {"name": "run_code", "arguments": ""}},
+                  {"function_call": {"arguments": '{"language": '}},
+                  {"function_call": {"arguments": '"python"}'}}]:
+        message = merge_deltas(message, delta)
+    assert message["function_call"]["arguments"] == '{"language": "python"}'
+    assert message == {"role": "assistant", "content": None, "function_call": {"name": "run_code", "arguments": '{"language": "python"}'}}
+    assert json.dumps(message.to_dict())
+
+def test_streaming_content_is_not_joined_per_chunk():
+    from interpreter.interpreter import Interpreter
+    interpreter = Interpreter()
+    interpreter.local = True
+    interpreter.headless = True
+    events = []
+    interpreter.event_callback = events.append
+    interpreter.messages.append({"role": "user", "content": "Hi"})
+    interpreter.start_response()
+
+    tokens = ["hello", " there", ",", " how", " are", " you?"]
+    for n, token in enumerate(tokens, start=1):
+        interpreter.handle_chunk({"choices": [{"text": token, "finish_reason": None}]})
+        # Every token is still its own fragment, so nothing read the whole content
+        assert len(interpreter.messages[-1].fields["content"]) == n
+        assert "content" in interpreter.messages[-1]
+
+    assert "".join(event["content"] for event in events) == "Hello there, how are you?"